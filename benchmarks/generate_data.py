@@ -0,0 +1,177 @@
+"""
+generates a synthetic multi-tenant dataset for the benchmarks: hospitals, a year of past shifts (mostly approved) and
+a couple months of upcoming shifts (open, requested or approved), each with a spread of requests.
+
+usage:
+    python benchmarks/generate_data.py --database-url sqlite:////tmp/shifthelper-bench.db
+    python benchmarks/generate_data.py --database-url postgresql://localhost/shifthelper_bench \
+        --hospitals 1000 --shifts-per-hospital 1000 --requests-per-shift 3
+
+hospital n logs in with admin-<n> / staff-<n>. the data is seeded, so the same arguments give the same dataset
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+DEFAULT_DATABASE_URL = f"sqlite:///{os.path.join(tempfile.gettempdir(), 'shifthelper-bench.db')}"
+
+AREAS = ['Emergency', 'ICU', 'Surgery', 'Pediatrics', 'Oncology', 'Cardiology', 'Radiology', 'Maternity']
+SHIFT_TIMES = [('07:00', '15:00'), ('07:00', '19:00'), ('15:00', '23:00'), ('19:00', '07:00'), ('23:00', '07:00')]
+FIRST_NAMES = ['Alex', 'Sam', 'Jordan', 'Taylor', 'Casey', 'Riley', 'Morgan', 'Jamie', 'Avery', 'Quinn']
+LAST_NAMES = ['Smith', 'Lee', 'Garcia', 'Patel', 'Nguyen', 'Brown', 'Kim', 'Lopez', 'Clark', 'Walker']
+
+PAST_DAYS = 365
+FUTURE_DAYS = 60
+
+
+def setup_app(database_url):
+    """
+    points the app at the benchmark database and imports it. has to happen before main is imported anywhere
+    """
+    os.environ['DATABASE_URL'] = database_url
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import main
+    main.app.config['WTF_CSRF_ENABLED'] = False
+    return main
+
+
+def insert_rows(main, table, rows):
+    if rows:
+        main.db.session.execute(table.insert(), rows)
+        rows.clear()
+
+
+def generate(main, hospitals, shifts_per_hospital, requests_per_shift, seed, hash_method, batch_size):
+    """
+    bulk inserts the dataset batch by batch, with explicit ids so requests can point at their shifts without a
+    round trip
+    """
+    rng = random.Random(seed)
+    shifts_table = main.Shifts.__table__
+    requests_table = main.Requests.__table__
+    today = date.today()
+    now = datetime.now().replace(second=0, microsecond=0)
+
+    hospital_rows = []
+    for number in range(1, hospitals + 1):
+        hospital_rows.append({
+            'id': number,
+            'hospital_name': f'Benchmark Hospital {number}',
+            'admin_name': f'Admin {number}',
+            'admin_email': f'admin{number}@example.com',
+            'admin_password': main.generate_password_hash(f'admin-{number}', method=hash_method, salt_length=8),
+            'staff_password': main.generate_password_hash(f'staff-{number}', method=hash_method, salt_length=8),
+            'admin_password_fingerprint': main.credential_fingerprint(f'admin-{number}'),
+            'staff_password_fingerprint': main.credential_fingerprint(f'staff-{number}'),
+            'created_date': now - timedelta(days=PAST_DAYS + 30),
+        })
+    insert_rows(main, main.Hospital.__table__, hospital_rows)
+
+    shift_rows, request_rows = [], []
+    shift_id = request_id = 0
+    for hospital_id in range(1, hospitals + 1):
+        for _ in range(shifts_per_hospital):
+            shift_id += 1
+            shift_date = today + timedelta(days=rng.randint(-PAST_DAYS, FUTURE_DAYS))
+            start_time, end_time = rng.choice(SHIFT_TIMES)
+            create_dt_tm = datetime.combine(shift_date, datetime.min.time()) - timedelta(days=rng.randint(1, 30))
+            request_count = rng.randint(0, 2 * requests_per_shift)
+            roll = rng.random()
+            if roll < 0.03:
+                status = 'Removed'
+            elif request_count == 0:
+                status = 'Posted'
+            elif shift_date < today or roll < 0.5:
+                status = 'Approved'
+            else:
+                status = 'Requested'
+
+            contact = rng.choice(FIRST_NAMES)
+            shift = {
+                'shift_id': shift_id, 'hospital_id': hospital_id, 'area': rng.choice(AREAS),
+                'role': rng.choice(main.ROLE_CHOICES), 'date': shift_date, 'start_time': start_time,
+                'end_time': end_time,
+                'comments': rng.choice(['', 'Float pool welcome', 'Charge experience preferred']),
+                'status': status, 'picked_up_by': None, 'approved_dt_tm': None, 'create_dt_tm': create_dt_tm,
+                'contact_name': contact, 'contact_email': f'{contact.lower()}{hospital_id}@example.com',
+                'request_count': request_count, 'last_request_dt_tm': None, 'series_id': None,
+            }
+            shift.update(main.shift_times(shift_date, start_time, end_time))
+
+            approved_index = rng.randrange(request_count) if status == 'Approved' and request_count else None
+            for index in range(request_count):
+                request_id += 1
+                first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+                request_dt_tm = create_dt_tm + timedelta(hours=rng.randint(1, 24 * 14))
+                if status == 'Approved':
+                    request_status = 'Approved' if index == approved_index else 'Passed'
+                elif status == 'Removed':
+                    request_status = 'Passed'
+                else:
+                    request_status = 'Requested'
+                request_rows.append({
+                    'transaction_id': request_id, 'shift_id': shift_id, 'hospital_id': hospital_id,
+                    'status': request_status, 'create_dt_tm': request_dt_tm,
+                    'approved_dt_tm': request_dt_tm if request_status == 'Approved' else None,
+                    'requested_by_name': f'{first} {last}',
+                    'requested_by_email': f'{first.lower()}.{last.lower()}{request_id}@example.com',
+                    'requested_by_phone': f'555-{request_id % 10000:04d}', 'comments': '',
+                })
+                if request_status == 'Approved':
+                    shift['picked_up_by'] = request_rows[-1]['requested_by_email']
+                    shift['approved_dt_tm'] = request_dt_tm
+                shift['last_request_dt_tm'] = max(shift['last_request_dt_tm'] or request_dt_tm, request_dt_tm)
+            shift_rows.append(shift)
+
+            if len(shift_rows) >= batch_size:
+                insert_rows(main, shifts_table, shift_rows)
+            if len(request_rows) >= batch_size:
+                insert_rows(main, requests_table, request_rows)
+        main.db.session.commit()
+    insert_rows(main, shifts_table, shift_rows)
+    insert_rows(main, requests_table, request_rows)
+    main.db.session.commit()
+
+    if main.db.engine.dialect.name == 'postgresql':
+        # the explicit ids skip the serial sequences, so move them past the generated rows
+        for table, column in (('hospital', 'id'), ('shifts', 'shift_id'), ('requests', 'transaction_id')):
+            main.db.session.execute(f"SELECT setval(pg_get_serial_sequence('{table}', '{column}'), "
+                                    f"(SELECT MAX({column}) FROM {table}))")
+        main.db.session.commit()
+    return shift_id, request_id
+
+
+def main_command():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', default=DEFAULT_DATABASE_URL)
+    parser.add_argument('--hospitals', type=int, default=50)
+    parser.add_argument('--shifts-per-hospital', type=int, default=500)
+    parser.add_argument('--requests-per-shift', type=int, default=3,
+                        help='average requests per shift (each shift gets between 0 and twice this many)')
+    parser.add_argument('--seed', type=int, default=2024)
+    parser.add_argument('--hash-method', default='pbkdf2:sha256:1000',
+                        help="password hash for the generated logins. the app's real default (pbkdf2:sha256) is "
+                             "much slower to generate, and makes the login benchmark measure the hash")
+    parser.add_argument('--batch-size', type=int, default=10000)
+    args = parser.parse_args()
+
+    main = setup_app(args.database_url)
+    with main.app.app_context():
+        main.upgrade_db()
+        if main.Hospital.query.first() is not None:
+            sys.exit(f"{args.database_url} already has data in it, generate into an empty database")
+
+        start = time.perf_counter()
+        shift_count, request_count = generate(main, args.hospitals, args.shifts_per_hospital,
+                                              args.requests_per_shift, args.seed, args.hash_method, args.batch_size)
+        print(f"generated {args.hospitals} hospitals, {shift_count} shifts and {request_count} requests "
+              f"in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == '__main__':
+    main_command()
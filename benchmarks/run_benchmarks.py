@@ -0,0 +1,279 @@
+"""
+drives the real routes through the Flask test client against a database made by generate_data.py and reports
+p50/p95/p99 latency, throughput and SQL queries per request for each one.
+
+usage:
+    python benchmarks/run_benchmarks.py --database-url sqlite:////tmp/shifthelper-bench.db
+    python benchmarks/run_benchmarks.py --save-baseline benchmarks/baselines/sqlite.json
+    python benchmarks/run_benchmarks.py --baseline benchmarks/baselines/sqlite.json
+
+with --baseline the run exits with status 1 if any route's p95 got slower than the tolerance allows or it runs more
+queries than it used to. request_shift and approve_request write to the database, so SQLite databases are copied
+and the copy is benchmarked (unless --in-place). on Postgres regenerate the data before comparing runs
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import date, datetime
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from generate_data import DEFAULT_DATABASE_URL, setup_app  # noqa: E402
+
+# read routes go first so the writes don't change what they read
+SCENARIOS = ['login', 'shifts', 'shifts_data', 'pending_shifts', 'request_detail', 'shift_history',
+             'shift_history_data', 'request_shift', 'approve_request']
+
+DATATABLES_ARGS = {'draw': 1, 'start': 0, 'length': 10, 'order[0][column]': 2, 'order[0][dir]': 'asc',
+                   'search[value]': ''}
+
+
+class QueryCounter:
+    """
+    counts the SQL statements the app runs, so each request's query count is the difference around it
+    """
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.count = 0
+        event.listen(engine, 'after_cursor_execute', self.record)
+
+    def record(self, *args):
+        self.count += 1
+
+
+class Targets:
+    """
+    the hospitals, shifts and requests the scenarios pick from, chosen up front so finding them isn't timed
+    """
+    def __init__(self, main, hospital_sample, pool_size, rng):
+        db, Shifts, Requests = main.db, main.Shifts, main.Requests
+        hospital_ids = [row.id for row in db.session.query(main.Hospital.id).order_by(main.Hospital.id)]
+        if not hospital_ids:
+            sys.exit("the benchmark database is empty, run generate_data.py first")
+        self.hospital_ids = rng.sample(hospital_ids, min(hospital_sample, len(hospital_ids)))
+        today = date.today()
+
+        self.open_shifts = [(row.hospital_id, row.shift_id) for row in db.session.query(Shifts)
+                            .filter(Shifts.hospital_id.in_(self.hospital_ids), Shifts.date >= today,
+                                    Shifts.status.in_(['Posted', 'Requested']))
+                            .with_entities(Shifts.hospital_id, Shifts.shift_id)
+                            .order_by(Shifts.shift_id).limit(pool_size * 4)]
+        rng.shuffle(self.open_shifts)
+
+        # one pending request per requested shift, since approving it closes the shift
+        pending = db.session.query(Requests) \
+            .join(Shifts, Shifts.shift_id == Requests.shift_id) \
+            .filter(Shifts.hospital_id.in_(self.hospital_ids), Shifts.date >= today, Shifts.status == 'Requested',
+                    Requests.status == 'Requested') \
+            .with_entities(Shifts.hospital_id, Shifts.shift_id, Requests.transaction_id) \
+            .order_by(Requests.shift_id, Requests.transaction_id)
+        self.pending_requests = list({row.shift_id: (row.hospital_id, row.shift_id, row.transaction_id)
+                                      for row in pending}.values())
+        rng.shuffle(self.pending_requests)
+        # request_shift turns open shifts into requested ones, so keep the two pools apart
+        pending_shift_ids = {shift_id for _, shift_id, _ in self.pending_requests}
+        self.request_shifts = [shift for shift in self.open_shifts if shift[1] not in pending_shift_ids]
+
+
+def build_requests(targets):
+    """
+    returns {scenario: function(clients, iteration) -> response}
+    """
+    def hospital(iteration):
+        return targets.hospital_ids[iteration % len(targets.hospital_ids)]
+
+    def open_shift(iteration):
+        return targets.open_shifts[iteration % len(targets.open_shifts)]
+
+    def login(clients, iteration):
+        return clients.anonymous.post('/login', data={'password': f'admin-{hospital(iteration)}'})
+
+    def shifts(clients, iteration):
+        return clients.anonymous.get('/shifts', query_string={'hospital_id': hospital(iteration)})
+
+    def shifts_data(clients, iteration):
+        return clients.anonymous.get('/shifts/data', query_string=dict(DATATABLES_ARGS,
+                                                                         hospital_id=hospital(iteration)))
+
+    def pending_shifts(clients, iteration):
+        return clients.admin(hospital(iteration)).get('/pending_shifts')
+
+    def request_detail(clients, iteration):
+        hospital_id, shift_id = open_shift(iteration)
+        return clients.admin(hospital_id).get('/request_details', query_string={'id': shift_id})
+
+    def shift_history(clients, iteration):
+        return clients.anonymous.get('/shift_history', query_string={'hospital_id': hospital(iteration)})
+
+    def shift_history_data(clients, iteration):
+        return clients.anonymous.get('/shift_history/data', query_string=dict(DATATABLES_ARGS,
+                                                                                hospital_id=hospital(iteration)))
+
+    def request_shift(clients, iteration):
+        _, shift_id = targets.request_shifts[iteration % len(targets.request_shifts)]
+        return clients.anonymous.post('/request_shift', query_string={'id': shift_id}, data={
+            'requestor_name': 'Bench Mark', 'requestor_email': f'bench{iteration}@example.com',
+            'requestor_phone_num': '555-0000', 'requestor_comments': ''})
+
+    def approve_request(clients, iteration):
+        hospital_id, shift_id, request_id = targets.pending_requests[iteration]
+        return clients.admin(hospital_id).post('/approve_request',
+                                               data={'shift_id': shift_id, 'request_id': request_id})
+
+    return {name: function for name, function in locals().items() if name in SCENARIOS}
+
+
+class Clients:
+    """
+    a logged out test client plus one logged in client per hospital
+    """
+    def __init__(self, app):
+        self.app = app
+        self.anonymous = app.test_client()
+        self.admins = {}
+
+    def admin(self, hospital_id):
+        if hospital_id not in self.admins:
+            client = self.app.test_client()
+            with client.session_transaction() as sess:
+                sess['_user_id'] = str(hospital_id)
+                sess['_fresh'] = True
+            self.admins[hospital_id] = client
+        return self.admins[hospital_id]
+
+
+def percentile(sorted_values, fraction):
+    """
+    nearest-rank percentile of an already sorted list
+    """
+    return sorted_values[max(math.ceil(fraction * len(sorted_values)) - 1, 0)]
+
+
+def run_scenario(function, clients, query_counter, iterations, warmup):
+    for iteration in range(warmup):
+        function(clients, iteration)
+
+    latencies, query_counts, statuses = [], [], Counter()
+    start = time.perf_counter()
+    for iteration in range(warmup, warmup + iterations):
+        queries_before = query_counter.count
+        request_start = time.perf_counter()
+        response = function(clients, iteration)
+        latencies.append(time.perf_counter() - request_start)
+        query_counts.append(query_counter.count - queries_before)
+        statuses[response.status_code] += 1
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'mean_ms': round(statistics.mean(latencies) * 1000, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 1),
+        'queries_per_request': round(statistics.mean(query_counts), 2),
+        'statuses': {str(status): count for status, count in sorted(statuses.items())},
+    }
+
+
+def compare(results, baseline, tolerance, min_slowdown_ms):
+    """
+    the regressions against a saved baseline, as readable lines
+    """
+    regressions = []
+    for name, result in results.items():
+        previous = baseline['results'].get(name)
+        if previous is None:
+            continue
+        if result['p95_ms'] > previous['p95_ms'] * (1 + tolerance) and \
+                result['p95_ms'] - previous['p95_ms'] > min_slowdown_ms:
+            regressions.append(f"{name}: p95 {result['p95_ms']}ms vs {previous['p95_ms']}ms baseline")
+        if result['queries_per_request'] > previous['queries_per_request'] + 0.5:
+            regressions.append(f"{name}: {result['queries_per_request']} queries per request vs "
+                               f"{previous['queries_per_request']} baseline")
+    return regressions
+
+
+def main_command():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', default=DEFAULT_DATABASE_URL)
+    parser.add_argument('--iterations', type=int, default=200, help='timed requests per route')
+    parser.add_argument('--warmup', type=int, default=20, help='untimed requests per route before timing')
+    parser.add_argument('--hospitals', type=int, default=20, help='how many hospitals the requests are spread over')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, help='only run these routes')
+    parser.add_argument('--seed', type=int, default=2024)
+    parser.add_argument('--in-place', action='store_true', help="benchmark a SQLite database directly, not a copy")
+    parser.add_argument('--baseline', help='baseline json to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed p95 slowdown against the baseline')
+    parser.add_argument('--min-slowdown-ms', type=float, default=2,
+                        help="p95 slowdowns smaller than this are noise, whatever the tolerance says")
+    parser.add_argument('--save-baseline', help='write the results to this json file')
+    args = parser.parse_args()
+
+    database_url = args.database_url
+    if database_url.startswith('sqlite:///') and not args.in_place:
+        source = database_url[len('sqlite:///'):]
+        copy = os.path.join(tempfile.mkdtemp(prefix='shifthelper-bench-'), os.path.basename(source))
+        shutil.copy(source, copy)
+        database_url = f'sqlite:///{copy}'
+
+    main = setup_app(database_url)
+    rng = random.Random(args.seed)
+    scenarios = args.scenario or SCENARIOS
+    with main.app.app_context():
+        main.upgrade_db()
+        pool_size = args.iterations + args.warmup
+        targets = Targets(main, args.hospitals, pool_size, rng)
+        dataset = {'hospitals': main.Hospital.query.count(), 'shifts': main.Shifts.query.count(),
+                   'requests': main.Requests.query.count()}
+        dialect = main.db.engine.dialect.name
+        main.db.session.remove()
+    requests = build_requests(targets)
+    query_counter = QueryCounter(main.db.get_engine(main.app))
+    clients = Clients(main.app)
+
+    print(f"{dialect}: {dataset['hospitals']} hospitals, {dataset['shifts']} shifts, {dataset['requests']} requests")
+    print(f"{'route':<20}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>10}{'queries':>9}  statuses")
+    results = {}
+    for name in scenarios:
+        if name == 'approve_request' and len(targets.pending_requests) < pool_size or \
+                name in ('request_detail', 'request_shift') and not targets.request_shifts:
+            print(f"{name:<20}skipped, not enough open shifts in the sampled hospitals (generate more data)")
+            continue
+        result = results[name] = run_scenario(requests[name], clients, query_counter, args.iterations, args.warmup)
+        statuses = ' '.join(f'{status}x{count}' for status, count in result['statuses'].items())
+        print(f"{name:<20}{result['requests']:>6}{result['p50_ms']:>10}{result['p95_ms']:>10}{result['p99_ms']:>10}"
+              f"{result['throughput_rps']:>10}{result['queries_per_request']:>9}  {statuses}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump({'created': datetime.now().isoformat(timespec='seconds'), 'database': dialect,
+                       'dataset': dataset, 'iterations': args.iterations, 'python': platform.python_version(),
+                       'results': results}, baseline_file, indent=2)
+            baseline_file.write('\n')
+        print(f"saved baseline to {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline['dataset'] != dataset:
+            print(f"warning: the baseline was taken against a different dataset ({baseline['dataset']})")
+        regressions = compare(results, baseline, args.tolerance, args.min_slowdown_ms)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"no regressions against {args.baseline}")
+
+
+if __name__ == '__main__':
+    main_command()
@@ -0,0 +1,53 @@
+"""
+measures how long a fresh process takes to import main.py, which is most of a worker's cold start.
+
+usage:
+    python benchmarks/startup_time.py
+    python benchmarks/startup_time.py --runs 20
+
+it also times importing main.py with pandas and openpyxl loaded up front, as they were before they became lazy
+imports, to show what that saves
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+VARIANTS = [
+    ('import main', 'import main'),
+    ('import main with pandas + openpyxl', 'import pandas, openpyxl; import main'),
+]
+
+
+def time_import(code, runs, env):
+    """
+    wall clock seconds for each of `runs` fresh interpreters to run code
+    """
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], cwd=REPO_DIR, env=env, check=True)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main_command():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    env = dict(os.environ, SECRET_KEY=os.environ.get('SECRET_KEY', 'benchmark'), WORKER_THREAD='0')
+    baseline = statistics.median(time_import('pass', args.runs, env))
+    print(f"{'':<40}{'median':>10}{'min':>10}")
+    print(f"{'empty interpreter':<40}{baseline * 1000:>8.0f}ms")
+    for label, code in VARIANTS:
+        timings = time_import(code, args.runs, env)
+        print(f"{label:<40}{statistics.median(timings) * 1000:>8.0f}ms{min(timings) * 1000:>8.0f}ms")
+
+
+if __name__ == '__main__':
+    main_command()
@@ -0,0 +1,64 @@
+"""
+gunicorn settings for the web process (see the Procfile):
+
+    gunicorn -c gunicorn.conf.py main:app
+
+WEB_CONCURRENCY sets the worker processes. GUNICORN_WORKER_CLASS is gthread (the default) or gevent, which needs
+`pip install gevent psycogreen`. GUNICORN_THREADS sets the threads per gthread worker, and GUNICORN_WORKER_CONNECTIONS
+the greenlets per gevent worker. DB_MAX_CONNECTIONS is how many connections the database allows this dyno in total;
+they're shared out between the workers' pools. gevent suits many open live feeds best, since gthread can only keep a
+few of them open per worker
+"""
+import multiprocessing
+import os
+import time
+
+started = time.monotonic()
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8000)}"
+workers = int(os.environ.get('WEB_CONCURRENCY', min(multiprocessing.cpu_count() * 2 + 1, 8)))
+# threads (or greenlets) let a worker keep serving while a request waits on PBKDF2, the database or a live feed
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 100))
+timeout = 60
+graceful_timeout = 30
+keepalive = 5
+
+# import main.py once in the master and fork the workers from it, so they start faster and share its memory
+preload_app = True
+
+# the background worker thread would start in the master as main.py is preloaded, and the workers would then be
+# forked from a process with a thread that may be holding locks (logging, the connection pool) mid-query. under
+# gunicorn the background worker runs as its own process instead (the worker entry in the Procfile)
+if os.environ.get('WORKER_THREAD') == '1':
+    raise RuntimeError("WORKER_THREAD=1 can't be used with gunicorn's preload_app, run `flask worker` "
+                       "(the Procfile's worker entry) instead")
+
+if worker_class == 'gevent':
+    # patched before main.py is preloaded, so its locks, sockets and database driver all cooperate with gevent
+    from gevent import monkey
+    monkey.patch_all()
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+
+# every worker gets a connection for each request it can run at once, as far as the database allows.
+# main.py reads these when it's preloaded
+concurrency = worker_connections if worker_class == 'gevent' else threads
+connections_per_worker = max(int(os.environ.get('DB_MAX_CONNECTIONS', 20)) // workers, 2)
+os.environ.setdefault('DB_POOL_SIZE', str(min(concurrency, connections_per_worker)))
+os.environ.setdefault('DB_MAX_OVERFLOW', str(max(connections_per_worker - int(os.environ['DB_POOL_SIZE']), 0)))
+# each open live feed (/events) holds a thread or greenlet for minutes, so they may only take up half of a gthread
+# worker's threads (the rest of its browsers poll) and most of a gevent worker's greenlets, which are much cheaper
+os.environ.setdefault('EVENT_STREAMS_PER_PROCESS',
+                      str(worker_connections * 3 // 4 if worker_class == 'gevent' else max(threads // 2, 1)))
+
+
+def when_ready(server):
+    server.log.info(f"app loaded and listening {time.monotonic() - started:.2f}s after start "
+                    f"({workers} {worker_class} workers, db pool {os.environ['DB_POOL_SIZE']}"
+                    f"+{os.environ['DB_MAX_OVERFLOW']} per worker)")
+
+
+def post_worker_init(worker):
+    worker.log.info(f"worker {worker.pid} ready {time.monotonic() - started:.2f}s after start")
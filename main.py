@@ -1,20 +1,47 @@
-from flask import Flask, render_template, request, url_for, redirect, flash, send_from_directory, session, Markup
+from flask import Flask, render_template, request, url_for, redirect, flash, send_from_directory, session, Markup, \
+    jsonify, Response, stream_with_context, send_file, abort, g, has_request_context
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import Signer, BadSignature
+from werkzeug.datastructures import CallbackDict
 from flask_bootstrap import Bootstrap
 from flask_login import UserMixin, login_user, LoginManager, login_required, current_user, logout_user
-from flask_session import Session
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import and_, case, event, exc, exists, inspect, literal, literal_column, or_, select, table, \
+    union, union_all, MetaData
+from sqlalchemy import text as text_clause
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.schema import CreateTable
 from sqlalchemy.sql import func
+from sqlalchemy.sql.dml import UpdateBase
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileAllowed, FileRequired
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
-from wtforms import StringField, PasswordField, SubmitField, SelectField
-from wtforms.fields.html5 import DateField, EmailField
-from wtforms.validators import DataRequired, Email, Length
+from wtforms import StringField, PasswordField, SubmitField, SelectField, SelectMultipleField, ValidationError
+from wtforms.fields.html5 import DateField, EmailField, IntegerField
+from wtforms.validators import DataRequired, Email, Length, NumberRange
 from dotenv import load_dotenv
-from datetime import datetime, date
+from collections import OrderedDict
+from datetime import datetime, date, time as dt_time, timedelta
+from email.message import EmailMessage
+import base64
+import csv
+import functools
+import hashlib
+import hmac
+import io
+import json
+import click
 import os
-import pandas as pd
+import queue
+import re
+import secrets
 import smtplib
+import tempfile
+import threading
+import time
+import zipfile
 
 abspath = os.path.abspath(__file__)
 dirname = os.path.dirname(abspath)
@@ -22,6 +49,12 @@ dirname = os.path.dirname(abspath)
 email_address = os.environ.get("EMAIL")
 email_password = os.environ.get("EMAIL_PASSWORD")
 
+# mail server used by the background worker. for offline testing point it at a local stand-in, e.g.
+# `python -m aiosmtpd -n -l localhost:8025` with SMTP_HOST=localhost SMTP_PORT=8025 SMTP_STARTTLS=0
+smtp_host = os.environ.get("SMTP_HOST", "smtp.office365.com")
+smtp_port = int(os.environ.get("SMTP_PORT", 587))
+smtp_starttls = os.environ.get("SMTP_STARTTLS", "1") == "1"
+
 app = Flask(__name__)
 debug = False
 DEV = False
@@ -32,133 +65,2600 @@ if DEV:
     load_dotenv(os.path.join(parent_path, 'info.env'))
     app.config['SECRET_KEY'] = os.getenv("SECRET_KEY")
 
-app.config['SECRET_KEY'] = os.environ.get("SECRET_KEY")
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get("DATABASE_URL", "sqlite:///shifthelper.db")
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config["SESSION_PERMANENT"] = False
-app.config["SESSION_TYPE"] = 'filesystem'
+app.config['SECRET_KEY'] = os.environ.get("SECRET_KEY")
+# key for the login fingerprints below; changing it means every hospital needs new logins (see reset-login)
+app.config['CREDENTIAL_KEY'] = os.environ.get("CREDENTIAL_KEY", app.config['SECRET_KEY'])
+# hospitals whose logins predate the fingerprints are found by checking their hashes one by one, but only for
+# LEGACY_LOGIN_GRACE_DAYS after the fingerprints were added. after that they need new logins (see reset-login)
+app.config['LEGACY_LOGIN_GRACE_DAYS'] = int(os.environ.get("LEGACY_LOGIN_GRACE_DAYS", 90))
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get("DATABASE_URL", "sqlite:///shifthelper.db")
+app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# connections are checked before use so ones the database dropped are replaced instead of failing a request. the pool
+# is per process; gunicorn.conf.py sizes it to each worker's threads and the database's connection limit
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_pre_ping': True}
+if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'].update(
+        pool_size=int(os.environ.get("DB_POOL_SIZE", 5)),
+        max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", 5)),
+        pool_timeout=int(os.environ.get("DB_POOL_TIMEOUT", 10)),
+        pool_recycle=int(os.environ.get("DB_POOL_RECYCLE", 30 * 60))
+    )
+# optional read replica for the read-only pages (see read_replica). to try it locally copy the sqlite database and run
+# `flask sync-replica` to refresh the copy. a browser that has just written anything reads from the primary for
+# READ_PRIMARY_SECONDS afterwards, so people always see their own changes despite replication lag
+app.config['REPLICA_DATABASE_URL'] = os.environ.get("REPLICA_DATABASE_URL")
+if app.config['REPLICA_DATABASE_URL']:
+    app.config['SQLALCHEMY_BINDS'] = {'replica': app.config['REPLICA_DATABASE_URL']}
+app.config['READ_PRIMARY_SECONDS'] = int(os.environ.get("READ_PRIMARY_SECONDS", 15))
+# server-side sessions (see DatabaseSessionInterface) expire after this many seconds without use
+app.config['SESSION_TTL'] = int(os.environ.get("SESSION_TTL", 12 * 60 * 60))
+app.config['SESSION_SWEEP_SECONDS'] = int(os.environ.get("SESSION_SWEEP_SECONDS", 300))
+app.config['SESSION_SWEEP_BATCH_SIZE'] = 1000
+app.config['PAGE_SIZE'] = 10
+app.config['MAX_PAGE_SIZE'] = 100
+app.config['EXPORT_CHUNK_SIZE'] = 1000
+# longest shift the availability search has to account for (overnight shifts end the next day)
+app.config['MAX_SHIFT_HOURS'] = 24
+app.config['MAX_SERIES_DAYS'] = 366
+# public address of the app, used for links in emails sent by the background worker. the new shift digests are only
+# sent when it is set, since each one has to carry a working unsubscribe link
+app.config['BASE_URL'] = os.environ.get("BASE_URL", "")
+app.config['DIGEST_SECONDS'] = int(os.environ.get("DIGEST_SECONDS", 60 * 60))
+# shifts are picked up by the digest this long after they're posted so slow transactions aren't skipped
+app.config['DIGEST_DELAY_SECONDS'] = 60
+# how often each web process checks for new shift events, and how long one live feed connection is kept open before
+# the browser is asked to reconnect
+app.config['EVENT_POLL_SECONDS'] = 0.5
+app.config['EVENT_STREAM_SECONDS'] = 300
+# each open live feed holds a thread of its web process, so only EVENT_STREAMS_PER_PROCESS are kept open at once and
+# the browsers beyond that poll every EVENT_FALLBACK_POLL_SECONDS instead. gunicorn.conf.py sets it from the worker's
+# threads or greenlets
+app.config['EVENT_STREAMS_PER_PROCESS'] = int(os.environ.get("EVENT_STREAMS_PER_PROCESS", 4))
+app.config['EVENT_FALLBACK_POLL_SECONDS'] = 20
+app.config['EVENT_RETENTION_SECONDS'] = 60 * 60
+app.config['EVENT_PRUNE_SECONDS'] = 10 * 60
+# shifts more than ARCHIVE_AFTER_DAYS in the past are moved (with their requests) to the archive tables
+app.config['ARCHIVE_AFTER_DAYS'] = int(os.environ.get("ARCHIVE_AFTER_DAYS", 30))
+app.config['ARCHIVE_SECONDS'] = int(os.environ.get("ARCHIVE_SECONDS", 6 * 60 * 60))
+app.config['ARCHIVE_BATCH_SIZE'] = 1000
+# past shifts nobody filled are marked Expired (with their pending requests) every EXPIRY_SECONDS, optionally with a
+# summary email to each hospital's admin
+app.config['EXPIRY_SECONDS'] = int(os.environ.get("EXPIRY_SECONDS", 15 * 60))
+app.config['EXPIRY_BATCH_SIZE'] = 1000
+app.config['EXPIRY_SUMMARY_EMAILS'] = os.environ.get("EXPIRY_SUMMARY_EMAILS") == "1"
+app.config['EXPIRY_SUMMARY_MAX_SHIFTS'] = 50
+# migrations that backfill a column row by row do it MIGRATION_BATCH_SIZE rows (and one commit) at a time
+app.config['MIGRATION_BATCH_SIZE'] = 1000
+# the analytics rollups take in shifts closed up to ROLLUP_DELAY_SECONDS ago every ROLLUP_SECONDS. the delay leaves
+# time for the transactions that closed them to commit
+app.config['ROLLUP_SECONDS'] = int(os.environ.get("ROLLUP_SECONDS", 15 * 60))
+app.config['ROLLUP_DELAY_SECONDS'] = 60
+app.config['ANALYTICS_WEEKS'] = 12
+# the JSON API (/api/v1) takes at most API_BATCH_SIZE items per batch call. a token's last use is recorded at most
+# every API_TOKEN_TOUCH_SECONDS so API calls don't all write to the token table
+app.config['API_BATCH_SIZE'] = 500
+app.config['API_TOKEN_TOUCH_SECONDS'] = 5 * 60
+# /metrics needs an "Authorization: Bearer <METRICS_TOKEN>" header, and isn't served at all when it isn't set
+app.config['METRICS_TOKEN'] = os.environ.get("METRICS_TOKEN")
+# if set, requests slower than this many seconds are logged along with the SQL they ran
+app.config['SLOW_REQUEST_SECONDS'] = float(os.environ.get("SLOW_REQUEST_SECONDS", 0)) or None
+app.config['HOSPITAL_CACHE_SIZE'] = int(os.environ.get("HOSPITAL_CACHE_SIZE", 1024))
+app.config['HOSPITAL_CACHE_TTL'] = int(os.environ.get("HOSPITAL_CACHE_TTL", 300))
+app.config['BOARD_CACHE_SIZE'] = int(os.environ.get("BOARD_CACHE_SIZE", 512))
+app.config['BOARD_CACHE_TTL'] = int(os.environ.get("BOARD_CACHE_TTL", 3600))
+app.config['OUTBOX_BATCH_SIZE'] = int(os.environ.get("OUTBOX_BATCH_SIZE", 50))
+app.config['OUTBOX_POLL_SECONDS'] = float(os.environ.get("OUTBOX_POLL_SECONDS", 2))
+app.config['OUTBOX_MAX_ATTEMPTS'] = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", 6))
+app.config['OUTBOX_RETRY_SECONDS'] = int(os.environ.get("OUTBOX_RETRY_SECONDS", 30))
+# a worker claims a batch for this long; emails it hasn't got to by then (e.g. because it died) are picked up again
+app.config['OUTBOX_LEASE_SECONDS'] = int(os.environ.get("OUTBOX_LEASE_SECONDS", 10 * 60))
+# set WORKER_THREAD=1 to run the background worker (outbox and periodic jobs) from a thread inside the web process
+# instead of a separate worker process. only for running the app by itself (python main.py / flask run); gunicorn
+# refuses it since it preloads main.py before forking (see gunicorn.conf.py)
+app.config['WORKER_THREAD'] = os.environ.get("WORKER_THREAD") == "1"
+
+# allow app to use Bootstrap formatting
+Bootstrap(app)
+
+# allow app to have default current user characteristics such as is_authenticated status
+login_manager = LoginManager()
+login_manager.init_app(app)
+
+
+@login_manager.user_loader
+def load_user(user_id):
+    """
+    load the info for the current user
+    """
+    return get_hospital(user_id)
+
+
+class RoutingSession(SignallingSession):
+    """
+    session that sends the reads of read_replica requests to the replica. writes, flushes and everything else go to
+    the primary
+    """
+    def get_bind(self, mapper=None, clause=None):
+        if app.config['REPLICA_DATABASE_URL'] and has_request_context() and g.get('read_replica') and \
+                clause is not None and not isinstance(clause, UpdateBase) and not self._flushing:
+            return db.get_engine(app, bind='replica')
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+# allow SQLAlchemy to be incorporated from a db perspective
+db = RoutingSQLAlchemy(app)
+
+
+def database_engines():
+    """
+    the primary engine, and the replica's if there is one
+    """
+    engines = [db.engine]
+    if app.config['REPLICA_DATABASE_URL']:
+        engines.append(db.get_engine(app, bind='replica'))
+    return engines
+
+
+def listens_for_engines(identifier):
+    """
+    like event.listens_for, on every engine in database_engines
+    """
+    def register(listener):
+        for engine in database_engines():
+            event.listen(engine, identifier, listener)
+        return listener
+    return register
+
+
+@listens_for_engines('connect')
+def remember_connection_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+@listens_for_engines('checkout')
+def check_connection_pid(dbapi_connection, connection_record, connection_proxy):
+    """
+    stops a forked gunicorn worker from using a connection the preloaded master opened, which would share its socket
+    """
+    if connection_record.info['pid'] != os.getpid():
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(f"connection opened in process {connection_record.info['pid']}, "
+                                     f"not {os.getpid()}")
+
+
+# user class and db table
+class Hospital(UserMixin, db.Model):
+    """
+    The class (and db table) for the hospital data. Each entry will be a new "user" of the app.
+
+    This info ix mixed in as the user info so we can maintain info of the user that's currently logged in
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    hospital_name = db.Column(db.String(1000))
+    admin_name = db.Column(db.String(1000))
+    admin_email = db.Column(db.String(100))
+    admin_password = db.Column(db.String(1000))
+    staff_password = db.Column(db.String(1000))
+    created_date = db.Column(db.TIMESTAMP)
+    admin_password_fingerprint = db.Column(db.String(64), index=True)
+    staff_password_fingerprint = db.Column(db.String(64), index=True)
+
+
+class ShiftColumns:
+    """
+    the columns of a shift, shared by the live (Shifts) and archived (ShiftsArchive) tables
+    """
+    shift_id = db.Column(db.Integer, primary_key=True)
+    hospital_id = db.Column(db.Integer)
+    area = db.Column(db.String)
+    role = db.Column(db.String)
+    date = db.Column(db.Date)
+    start_time = db.Column(db.String)
+    end_time = db.Column(db.String)
+    comments = db.Column(db.String)
+    status = db.Column(db.String)
+    picked_up_by = db.Column(db.String)
+    approved_dt_tm = db.Column(db.TIMESTAMP)
+    create_dt_tm = db.Column(db.TIMESTAMP)
+    contact_name = db.Column(db.String)
+    contact_email = db.Column(db.String)
+    # kept up to date by request_shift so the pending board doesn't have to count requests on every load
+    request_count = db.Column(db.Integer, default=0, nullable=False, server_default='0')
+    last_request_dt_tm = db.Column(db.TIMESTAMP)
+    # start_time/end_time parsed into timestamps (see shift_times), None if the text couldn't be understood
+    start_dt_tm = db.Column(db.TIMESTAMP)
+    end_dt_tm = db.Column(db.TIMESTAMP)
+    # the recurring series (ShiftSeries) the shift was generated from, if any
+    series_id = db.Column(db.Integer, index=True)
+    # when the shift was approved, removed or expired. the analytics rollups pick up the shifts closed since they last
+    # ran from this
+    closed_dt_tm = db.Column(db.TIMESTAMP)
+
+
+class Shifts(ShiftColumns, db.Model):
+    """
+    The class (and db table) for the shift data. Each entry will be a distinct shift in the system
+    """
+    # the boards filter on hospital and status and then range over date, the availability search ranges over start
+    # and the digests over posting time
+    # AUTOINCREMENT so SQLite never hands out the id of a shift that's been archived (see autoincrement_live_ids)
+    __table_args__ = (db.Index('ix_shifts_hospital_status_date', 'hospital_id', 'status', 'date'),
+                      db.Index('ix_shifts_hospital_start', 'hospital_id', 'start_dt_tm'),
+                      db.Index('ix_shifts_create_dt_tm', 'create_dt_tm'),
+                      db.Index('ix_shifts_closed_dt_tm', 'closed_dt_tm'),
+                      {'sqlite_autoincrement': True})
+
+
+class RequestColumns:
+    """
+    the columns of a request, shared by the live (Requests) and archived (RequestsArchive) tables
+    """
+    transaction_id = db.Column(db.Integer, primary_key=True)
+    shift_id = db.Column(db.Integer)
+    hospital_id = db.Column(db.Integer)
+    status = db.Column(db.String)
+    create_dt_tm = db.Column(db.TIMESTAMP)
+    approved_dt_tm = db.Column(db.TIMESTAMP)
+    requested_by_name = db.Column(db.String)
+    requested_by_email = db.Column(db.String)
+    requested_by_phone = db.Column(db.String)
+    comments = db.Column(db.String)
+
+
+class Requests(RequestColumns, db.Model):
+    """
+    The class (and db table) for the request data. Each entry will be a distinct request in the system
+    """
+    # the API's request listing pages through a hospital's requests in id order. AUTOINCREMENT as for Shifts
+    __table_args__ = (db.Index('ix_requests_shift_status', 'shift_id', 'status'),
+                      db.Index('ix_requests_hospital_transaction', 'hospital_id', 'transaction_id'),
+                      {'sqlite_autoincrement': True})
+
+
+# statuses of a shift that can still be requested and approved. the others are Approved, Removed and Expired
+OPEN_SHIFT_STATUSES = ('Posted', 'Requested')
+
+
+class ShiftsArchive(ShiftColumns, db.Model):
+    """
+    The class (and db table) for archived shifts. archive_past_shifts moves shifts here, keeping their ids, once
+    they're ARCHIVE_AFTER_DAYS in the past so the live shifts table only holds current ones
+    """
+    __tablename__ = 'shifts_archive'
+    archived_dt_tm = db.Column(db.TIMESTAMP)
+
+    # history and exports filter on hospital and status and then range over date
+    __table_args__ = (db.Index('ix_shifts_archive_hospital_status_date', 'hospital_id', 'status', 'date'),
+                      db.Index('ix_shifts_archive_closed_dt_tm', 'closed_dt_tm'))
+
+
+class RequestsArchive(RequestColumns, db.Model):
+    """
+    The class (and db table) for the requests of archived shifts, moved along with their shift
+    """
+    __tablename__ = 'requests_archive'
+    archived_dt_tm = db.Column(db.TIMESTAMP)
+
+    # the request export filters on hospital and ranges over request time
+    __table_args__ = (db.Index('ix_requests_archive_hospital_create', 'hospital_id', 'create_dt_tm'),
+                      db.Index('ix_requests_archive_shift_status', 'shift_id', 'status'))
+
+
+class ShiftSeries(db.Model):
+    """
+    The class (and db table) for recurring shifts. Each entry is a template that's expanded into one Shifts row per
+    occurrence (see series_dates)
+    """
+    series_id = db.Column(db.Integer, primary_key=True)
+    hospital_id = db.Column(db.Integer, index=True)
+    area = db.Column(db.String)
+    role = db.Column(db.String)
+    start_time = db.Column(db.String)
+    end_time = db.Column(db.String)
+    comments = db.Column(db.String)
+    contact_name = db.Column(db.String)
+    contact_email = db.Column(db.String)
+    # comma separated weekday numbers, Monday is 0
+    weekdays = db.Column(db.String)
+    interval_weeks = db.Column(db.Integer)
+    start_date = db.Column(db.Date)
+    end_date = db.Column(db.Date)
+    # comma separated YYYY-MM-DD dates to skip
+    exclusions = db.Column(db.String)
+    status = db.Column(db.String)
+    create_dt_tm = db.Column(db.TIMESTAMP)
+
+
+class Subscription(db.Model):
+    """
+    The class (and db table) for staff signed up to hear about new shifts. Each entry is one email's subscription to
+    a hospital's shifts, optionally narrowed to an area and/or role
+    """
+    subscription_id = db.Column(db.Integer, primary_key=True)
+    hospital_id = db.Column(db.Integer)
+    email = db.Column(db.String)
+    area = db.Column(db.String)
+    role = db.Column(db.String)
+    token = db.Column(db.String(64), unique=True)
+    status = db.Column(db.String)
+    create_dt_tm = db.Column(db.TIMESTAMP)
+    last_digest_dt_tm = db.Column(db.TIMESTAMP)
+
+    # one subscription per email and filter. email and area are kept lowercase, and area and role are '' rather than
+    # NULL for "any", so the unique index covers them
+    __table_args__ = (db.Index('ix_subscription_hospital_status', 'hospital_id', 'status'),
+                      db.Index('ux_subscription_hospital_email_area_role', 'hospital_id', 'email', 'area', 'role',
+                               unique=True))
+
+
+# statuses of a shift that's done with: filled, taken down or passed without being filled
+CLOSED_SHIFT_STATUSES = ('Approved', 'Removed', 'Expired')
+
+
+class ShiftRollup(db.Model):
+    """
+    The class (and db table) for the daily staffing rollups. Each entry totals a hospital's closed shifts for one shift
+    date, area and role (see refresh_shift_rollups), so the analytics dashboard never has to read the shifts tables
+    """
+    __tablename__ = 'shift_rollup_daily'
+    hospital_id = db.Column(db.Integer, primary_key=True)
+    shift_date = db.Column(db.Date, primary_key=True)
+    area = db.Column(db.String, primary_key=True)
+    role = db.Column(db.String, primary_key=True)
+    shifts_filled = db.Column(db.Integer)
+    shifts_expired = db.Column(db.Integer)
+    shifts_removed = db.Column(db.Integer)
+    requests = db.Column(db.Integer)
+    # seconds from posting to approval summed over the filled shifts that have both timestamps, and how many those are
+    fill_seconds = db.Column(db.Float)
+    timed_fills = db.Column(db.Integer)
+
+
+class JobWatermark(db.Model):
+    """
+    The class (and db table) for how far each incremental background job has gotten
+    """
+    job_name = db.Column(db.String(100), primary_key=True)
+    watermark_dt_tm = db.Column(db.TIMESTAMP)
+
+
+class ApiToken(db.Model):
+    """
+    The class (and db table) for JSON API tokens. Each entry lets one integration (e.g. a scheduling system) use the
+    API on behalf of one hospital. only a hash of the token is kept (see create-api-token)
+    """
+    token_id = db.Column(db.Integer, primary_key=True)
+    hospital_id = db.Column(db.Integer)
+    name = db.Column(db.String)
+    token_hash = db.Column(db.String(64), unique=True)
+    create_dt_tm = db.Column(db.TIMESTAMP)
+    last_used_dt_tm = db.Column(db.TIMESTAMP)
+    revoked_dt_tm = db.Column(db.TIMESTAMP)
+
+
+# class to have a user sign up their location
+class SignupForm(FlaskForm):
+    """
+    structure of the signup form of a FlaskForm object
+    """
+    admin_name = StringField(label='Name', validators=[DataRequired()])
+    admin_email = EmailField(label='Email', validators=[DataRequired(), Email()])
+    hospital_name = StringField(label='Hospital Name', validators=[DataRequired()])
+    admin_password = StringField(label='Admin Login', validators=[Length(min=4)])
+    staff_password = StringField(label='Staff Login', validators=[Length(min=4)])
+    submit = SubmitField(label='Sign up')
+
+
+ROLE_CHOICES = ["RN", "CRNA", "Medical Assistant", "Scrub Tech"]
+
+
+# class to indicate the fields that'll be used on the app's Add Shift form
+class ShiftForm(FlaskForm):
+    """
+    structure of the add shift form of a FlaskForm object
+    """
+    area = StringField(label='Area (e.g. ICU)', validators=[DataRequired()])
+    role = SelectField(label='Role', choices=ROLE_CHOICES, validators=[DataRequired()])
+    date = DateField(label='Shift Date', format='%Y-%m-%d', validators=[DataRequired()])
+    start_time = StringField(label='Start Time (e.g. 8am)', validators=[DataRequired()])
+    end_time = StringField(label='End Time (e.g. 5pm)', validators=[DataRequired()])
+    contact_name = StringField(label="Contact's name", validators=[DataRequired()])
+    contact_email = EmailField(label="Contact's email", validators=[DataRequired(), Email()])
+    comments = StringField(label='Comments (competencies, random notes, etc.)')
+    submit = SubmitField(label="Add Open Shift")
+
+
+WEEKDAY_CHOICES = [('0', 'Monday'), ('1', 'Tuesday'), ('2', 'Wednesday'), ('3', 'Thursday'), ('4', 'Friday'),
+                   ('5', 'Saturday'), ('6', 'Sunday')]
+
+
+class ShiftSeriesForm(FlaskForm):
+    """
+    structure of the recurring shift form of a FlaskForm object
+    """
+    area = StringField(label='Area (e.g. ICU)', validators=[DataRequired()])
+    role = SelectField(label='Role', choices=ROLE_CHOICES, validators=[DataRequired()])
+    weekdays = SelectMultipleField(label='Repeats on', choices=WEEKDAY_CHOICES, validators=[DataRequired()])
+    interval_weeks = IntegerField(label='Every how many weeks', default=1, validators=[NumberRange(min=1, max=52)])
+    start_date = DateField(label='First Date', format='%Y-%m-%d', validators=[DataRequired()])
+    end_date = DateField(label='Last Date', format='%Y-%m-%d', validators=[DataRequired()])
+    exclusions = StringField(label='Skip these dates (YYYY-MM-DD, comma separated)')
+    start_time = StringField(label='Start Time (e.g. 7pm)', validators=[DataRequired()])
+    end_time = StringField(label='End Time (e.g. 7am)', validators=[DataRequired()])
+    contact_name = StringField(label="Contact's name", validators=[DataRequired()])
+    contact_email = EmailField(label="Contact's email", validators=[DataRequired(), Email()])
+    comments = StringField(label='Comments (competencies, random notes, etc.)')
+    submit = SubmitField(label="Save Recurring Shift")
+
+    def validate_end_date(self, field):
+        if self.start_date.data and field.data:
+            if field.data < self.start_date.data:
+                raise ValidationError('The last date has to be on or after the first date.')
+            if field.data - self.start_date.data > timedelta(days=app.config['MAX_SERIES_DAYS']):
+                raise ValidationError(f"A recurring shift can cover at most {app.config['MAX_SERIES_DAYS']} days.")
+
+    def validate_exclusions(self, field):
+        try:
+            parse_exclusions(field.data)
+        except ValueError:
+            raise ValidationError('Skipped dates have to be YYYY-MM-DD, separated by commas.')
+
+
+class SubscribeForm(FlaskForm):
+    """
+    structure of the new shift alerts form of a FlaskForm object
+    """
+    email = EmailField(label="What's your email?", validators=[DataRequired(), Email()])
+    area = StringField(label='Only shifts in this area (leave blank for any area)')
+    role = SelectField(label='Only shifts for this role', choices=[('', 'Any role')] + [(role, role) for role in
+                                                                                        ROLE_CHOICES])
+    submit = SubmitField(label="Send Me New Shifts")
+
+
+class ImportShiftsForm(FlaskForm):
+    """
+    structure of the bulk shift import form of a FlaskForm object
+    """
+    roster = FileField(label='Shift roster (.xlsx or .csv)',
+                       validators=[FileRequired(), FileAllowed(['xlsx', 'csv'], 'Please upload an .xlsx or .csv file')])
+    submit = SubmitField(label="Import Open Shifts")
+
+
+class RequestForm(FlaskForm):
+    """
+    structure of the request shift form of a FlaskForm object
+    """
+    requestor_name = StringField(label="What's your name?", validators=[DataRequired()])
+    label_for_email = Markup(
+        "What's your email? <span class='email-italic'>(will be used to provide updates on shift)</span>")
+    requestor_email = EmailField(label_for_email
+                                 , validators=[DataRequired(), Email()])
+    requestor_phone_num = StringField(label="What's your phone number?")
+    requestor_comments = StringField(label="Any comments you'd like to share?")
+    submit = SubmitField(label="Request Open Shift")
+
+
+class BoardVersion(db.Model):
+    """
+    The class (and db table) for each hospital's shift board version. It's bumped whenever one of the hospital's shifts
+    or requests changes, so pages built from an older version are known to be stale
+    """
+    hospital_id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_dt_tm = db.Column(db.TIMESTAMP)
+
+
+class ShiftEvent(db.Model):
+    """
+    The class (and db table) for the live board feed. Each entry is a change to a hospital's shifts (posted, requested,
+    approved, removed, updated), written in the same transaction as the change
+    """
+    event_id = db.Column(db.Integer, primary_key=True)
+    hospital_id = db.Column(db.Integer)
+    event_type = db.Column(db.String(50))
+    shift_id = db.Column(db.Integer)
+    payload = db.Column(db.Text)
+    create_dt_tm = db.Column(db.TIMESTAMP, index=True)
+
+    __table_args__ = (db.Index('ix_shift_event_hospital_event', 'hospital_id', 'event_id'),)
+
+
+class Outbox(db.Model):
+    """
+    The class (and db table) for outgoing emails. Each entry is an email waiting to be (or already) sent by the outbox
+    worker
+    """
+    email_id = db.Column(db.Integer, primary_key=True)
+    to_addrs = db.Column(db.String)
+    subject = db.Column(db.String)
+    body = db.Column(db.String)
+    status = db.Column(db.String)
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt_dt_tm = db.Column(db.TIMESTAMP)
+    last_error = db.Column(db.String)
+    create_dt_tm = db.Column(db.TIMESTAMP)
+    sent_dt_tm = db.Column(db.TIMESTAMP)
+
+    __table_args__ = (db.Index('ix_outbox_status_next_attempt', 'status', 'next_attempt_dt_tm'),)
+
+
+class WebSession(db.Model):
+    """
+    The class (and db table) for server-side sessions. Each entry is one browser's session data
+    """
+    session_id = db.Column(db.String(64), primary_key=True)
+    data = db.Column(db.Text)
+    expiry_dt_tm = db.Column(db.TIMESTAMP, index=True)
+
+
+class SchemaVersion(db.Model):
+    """
+    The class (and db table) that records which schema migrations have been applied to the database
+    """
+    version = db.Column(db.Integer, primary_key=True)
+    description = db.Column(db.String)
+    applied_dt_tm = db.Column(db.TIMESTAMP)
+
+
+def add_column(column):
+    """
+    adds a model column to an existing table if the table doesn't have it yet
+    """
+    table_name = column.table.name
+    existing_columns = [col['name'] for col in inspect(db.engine).get_columns(table_name)]
+    if column.name not in existing_columns:
+        column_type = column.type.compile(dialect=db.engine.dialect)
+        constraints = '' if column.nullable else ' NOT NULL'
+        if column.server_default is not None:
+            constraints += f' DEFAULT {column.server_default.arg}'
+        db.session.execute(f'ALTER TABLE {table_name} ADD COLUMN {column.name} {column_type}{constraints}')
+
+
+def add_index(index):
+    """
+    adds a model index to an existing table if the table doesn't have it yet
+    """
+    table_name = index.table.name
+    existing_indexes = [idx['name'] for idx in inspect(db.engine).get_indexes(table_name)]
+    if index.name not in existing_indexes:
+        index.create(bind=db.session.connection())
+
+
+def model_index(model, name):
+    """
+    the index with the given name from a model's table
+    """
+    return next(index for index in model.__table__.indexes if index.name == name)
+
+
+def add_login_fingerprints():
+    """
+    adds the indexed login fingerprint columns to the hospital table.
+
+    the logins are only stored as salted hashes so the fingerprints can't be computed here. existing hospitals are
+    backfilled the next time their logins are used (see match_login)
+    """
+    add_column(Hospital.__table__.c.admin_password_fingerprint)
+    add_column(Hospital.__table__.c.staff_password_fingerprint)
+    add_index(model_index(Hospital, 'ix_hospital_admin_password_fingerprint'))
+    add_index(model_index(Hospital, 'ix_hospital_staff_password_fingerprint'))
+
+
+def add_shift_request_indexes():
+    """
+    adds the composite indexes used by the shift boards and request lookups
+    """
+    add_index(model_index(Shifts, 'ix_shifts_hospital_status_date'))
+    add_index(model_index(Requests, 'ix_requests_shift_status'))
+
+
+def request_counter_values(while_open=True):
+    """
+    the request_count and last_request_dt_tm each shift should have, as correlated subqueries on requests. only the
+    requests made while the shift was open count, since request_shift used to take (and count) requests for shifts
+    that had already been approved or removed. while_open=False counts them all, for the migrations that run before
+    shifts had closed_dt_tm
+    """
+    criteria = [Requests.shift_id == Shifts.shift_id]
+    if while_open:
+        criteria.append(or_(Shifts.closed_dt_tm.is_(None), Requests.create_dt_tm <= Shifts.closed_dt_tm))
+    request_count = db.session.query(func.count(Requests.transaction_id)).filter(*criteria).as_scalar()
+    last_request_dt_tm = db.session.query(func.max(Requests.create_dt_tm)).filter(*criteria).as_scalar()
+    return request_count, last_request_dt_tm
+
+
+def rebuild_request_counters(while_open=True):
+    """
+    recomputes every shift's request counters from the requests table in one statement
+    """
+    request_count, last_request_dt_tm = request_counter_values(while_open)
+    return db.session.query(Shifts) \
+        .update({Shifts.request_count: request_count, Shifts.last_request_dt_tm: last_request_dt_tm},
+                synchronize_session=False)
+
+
+def add_request_counters():
+    """
+    adds the request counter columns to the shifts table and fills them in from the existing requests
+    """
+    add_column(Shifts.__table__.c.request_count)
+    add_column(Shifts.__table__.c.last_request_dt_tm)
+    rebuild_request_counters(while_open=False)
+
+
+SHIFT_TIME_PATTERN = re.compile(r'^(\d{1,2})(?::?(\d{2}))?\s*(?:([ap])\.?\s*m?\.?)?$', re.IGNORECASE)
+NAMED_SHIFT_TIMES = {'noon': dt_time(12), 'midnight': dt_time(0)}
+
+
+def parse_shift_time(text):
+    """
+    parses the free text times people type for shifts ("8am", "7:30 PM", "19:00", "0700", "noon") into a time, or
+    None if it can't be understood
+    """
+    text = (text or '').strip().lower()
+    if text in NAMED_SHIFT_TIMES:
+        return NAMED_SHIFT_TIMES[text]
+    match = SHIFT_TIME_PATTERN.match(text)
+    if not match:
+        return None
+    hour, minute, meridiem = int(match.group(1)), int(match.group(2) or 0), match.group(3)
+    if meridiem:
+        if not 1 <= hour <= 12:
+            return None
+        hour = hour % 12 + (12 if meridiem == 'p' else 0)
+    if hour > 23 or minute > 59:
+        return None
+    return dt_time(hour, minute)
+
+
+def shift_times(shift_date, start_time, end_time):
+    """
+    the start_dt_tm and end_dt_tm for a shift. a shift that ends at or before its start time is an overnight shift
+    ending the next day
+    """
+    start, end = parse_shift_time(start_time), parse_shift_time(end_time)
+    if isinstance(shift_date, datetime):
+        shift_date = shift_date.date()
+    if shift_date is None or start is None or end is None:
+        return {'start_dt_tm': None, 'end_dt_tm': None}
+    start_dt_tm = datetime.combine(shift_date, start)
+    end_dt_tm = datetime.combine(shift_date, end)
+    if end_dt_tm <= start_dt_tm:
+        end_dt_tm += timedelta(days=1)
+    return {'start_dt_tm': start_dt_tm, 'end_dt_tm': end_dt_tm}
+
+
+def add_shift_series():
+    """
+    adds the series link to the shifts table (the shift_series table itself is created by create_all)
+    """
+    add_column(Shifts.__table__.c.series_id)
+    add_index(model_index(Shifts, 'ix_shifts_series_id'))
+
+
+def add_shift_create_index():
+    """
+    adds the index the new shift digests use to find recently posted shifts
+    """
+    add_index(model_index(Shifts, 'ix_shifts_create_dt_tm'))
+
+
+def add_subscription_unique_index():
+    """
+    normalizes the subscriptions' emails and filters, drops the duplicates (keeping an active one where there is one)
+    and adds the unique index over them. existing subscriptions stay active
+    """
+    db.session.execute("UPDATE subscription SET email = lower(trim(email)), area = lower(coalesce(trim(area), '')), "
+                       "role = coalesce(role, '')")
+    db.session.execute("DELETE FROM subscription WHERE subscription_id NOT IN ("
+                       "SELECT coalesce(min(CASE WHEN status = 'Active' THEN subscription_id END), "
+                       "min(subscription_id)) FROM subscription GROUP BY hospital_id, email, area, role)")
+    add_index(model_index(Subscription, 'ux_subscription_hospital_email_area_role'))
+
+
+def add_request_hospital_index():
+    """
+    adds the index the API's request listing pages through
+    """
+    add_index(model_index(Requests, 'ix_requests_hospital_transaction'))
+
+
+def add_shift_timestamps():
+    """
+    adds the parsed shift timestamps to the shifts table and fills them in for the existing shifts
+    """
+    add_column(Shifts.__table__.c.start_dt_tm)
+    add_column(Shifts.__table__.c.end_dt_tm)
+    add_index(model_index(Shifts, 'ix_shifts_hospital_start'))
+    # the times are free text parsed in Python (see shift_times), so they're filled in a batch of shifts at a time,
+    # committing each one so a big table isn't held in memory or in a single transaction. the columns and index are
+    # only added if they're missing, so the migration picks up where it left off if it's interrupted
+    db.session.commit()
+    batch_size = app.config['MIGRATION_BATCH_SIZE']
+    last_shift_id = 0
+    while True:
+        batch = db.session.query(Shifts.shift_id, Shifts.date, Shifts.start_time, Shifts.end_time) \
+            .filter(Shifts.shift_id > last_shift_id) \
+            .order_by(Shifts.shift_id) \
+            .limit(batch_size) \
+            .all()
+        if not batch:
+            return
+        updates = [dict(shift_id=shift_id, **shift_times(shift_date, start_time, end_time))
+                   for shift_id, shift_date, start_time, end_time in batch]
+        db.session.bulk_update_mappings(Shifts, updates)
+        db.session.commit()
+        last_shift_id = batch[-1].shift_id
+
+
+def add_shift_closed_timestamps():
+    """
+    adds the closed timestamp the analytics rollups refresh from to the live and archived shifts. shifts closed before
+    it existed are covered by the rollups' first (full) build
+    """
+    add_column(Shifts.__table__.c.closed_dt_tm)
+    add_column(ShiftsArchive.__table__.c.closed_dt_tm)
+    add_index(model_index(Shifts, 'ix_shifts_closed_dt_tm'))
+    add_index(model_index(ShiftsArchive, 'ix_shifts_archive_closed_dt_tm'))
+
+
+def add_shift_search_index():
+    """
+    adds the full-text index over shift area, role and comments (see full_text_match) and fills it from the existing
+    shifts. the database keeps it in sync from then on, whichever route inserts, edits or deletes a shift:
+
+    - on SQLite it's an FTS5 table maintained by triggers on shifts. the hospital is indexed as a "h<id>" token so a
+      search only ever looks at one hospital's entries
+    - on Postgres it's a generated tsvector column on shifts with a GIN index
+    """
+    if db.engine.dialect.name == 'sqlite':
+        db.session.execute("CREATE VIRTUAL TABLE IF NOT EXISTS shift_search "
+                           "USING fts5(tenant, area, role, comments, tokenize='porter unicode61')")
+        db.session.execute("CREATE TRIGGER IF NOT EXISTS shift_search_insert AFTER INSERT ON shifts BEGIN "
+                           "INSERT INTO shift_search (rowid, tenant, area, role, comments) "
+                           "VALUES (new.shift_id, 'h' || new.hospital_id, new.area, new.role, new.comments); END")
+        db.session.execute("CREATE TRIGGER IF NOT EXISTS shift_search_update "
+                           "AFTER UPDATE OF hospital_id, area, role, comments ON shifts BEGIN "
+                           "DELETE FROM shift_search WHERE rowid = old.shift_id; "
+                           "INSERT INTO shift_search (rowid, tenant, area, role, comments) "
+                           "VALUES (new.shift_id, 'h' || new.hospital_id, new.area, new.role, new.comments); END")
+        db.session.execute("CREATE TRIGGER IF NOT EXISTS shift_search_delete AFTER DELETE ON shifts BEGIN "
+                           "DELETE FROM shift_search WHERE rowid = old.shift_id; END")
+        db.session.execute("DELETE FROM shift_search")
+        db.session.execute("INSERT INTO shift_search (rowid, tenant, area, role, comments) "
+                           "SELECT shift_id, 'h' || hospital_id, area, role, comments FROM shifts")
+    elif db.engine.dialect.name == 'postgresql':
+        db.session.execute("ALTER TABLE shifts ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS "
+                           "(setweight(to_tsvector('english', coalesce(area, '') || ' ' || coalesce(role, '')), 'A')"
+                           " || setweight(to_tsvector('english', coalesce(comments, '')), 'B')) STORED")
+        db.session.execute("CREATE INDEX IF NOT EXISTS ix_shifts_search_vector ON shifts USING gin (search_vector)")
+
+
+def rebuild_with_autoincrement(model, archive_model, references=()):
+    """
+    rebuilds a SQLite table with AUTOINCREMENT (copy, drop, rename, recreate the indexes) and starts its id sequence
+    past every id in its archive table. live rows that had already been given an archived row's id get new ids, and
+    so do the references columns pointing at them
+    """
+    table = model.__table__
+    id_column = next(iter(table.primary_key.columns)).name
+    table_sql = db.session.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name",
+                                   {'name': table.name}).scalar()
+    if 'AUTOINCREMENT' not in table_sql.upper():
+        columns = ', '.join(column.name for column in table.columns)
+        rebuilt_table = table.tometadata(MetaData(), name=f'{table.name}_rebuild')
+        db.session.execute(CreateTable(rebuilt_table))
+        db.session.execute(f'INSERT INTO {rebuilt_table.name} ({columns}) SELECT {columns} FROM {table.name}')
+        db.session.execute(f'DROP TABLE {table.name}')
+        db.session.execute(f'ALTER TABLE {rebuilt_table.name} RENAME TO {table.name}')
+        for index in table.indexes:
+            index.create(bind=db.session.connection())
+
+    archive_name = archive_model.__table__.name
+    last_id = db.session.execute(f'SELECT max(coalesce((SELECT max({id_column}) FROM {table.name}), 0), '
+                                 f'coalesce((SELECT max({id_column}) FROM {archive_name}), 0))').scalar()
+    reused_ids = [row[0] for row in db.session.execute(
+        f'SELECT {id_column} FROM {table.name} WHERE {id_column} IN (SELECT {id_column} FROM {archive_name}) '
+        f'ORDER BY {id_column}')]
+    for reused_id in reused_ids:
+        last_id += 1
+        for column in [table.c[id_column]] + list(references):
+            db.session.execute(column.table.update().where(column == reused_id).values({column.name: last_id}))
+    db.session.execute("DELETE FROM sqlite_sequence WHERE name = :name", {'name': table.name})
+    db.session.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (:name, :seq)",
+                       {'name': table.name, 'seq': last_id})
+
+
+def autoincrement_live_ids():
+    """
+    without AUTOINCREMENT SQLite gives new rows the highest id in use plus one, so once archive_past_shifts had
+    deleted the newest shifts their ids were handed out again and clashed with the archived rows. the live shifts and
+    requests tables are rebuilt with it (see rebuild_with_autoincrement), which also drops the shifts table's search
+    triggers, so the search index is set up again. Postgres sequences never reuse ids
+    """
+    if db.engine.dialect.name != 'sqlite':
+        return
+    rebuild_with_autoincrement(Shifts, ShiftsArchive,
+                               references=[Requests.__table__.c.shift_id, ShiftEvent.__table__.c.shift_id])
+    rebuild_with_autoincrement(Requests, RequestsArchive)
+    add_shift_search_index()
+
+
+def recount_open_requests():
+    """
+    rebuilds the request counters, dropping the requests that were taken for shifts after they'd closed
+    """
+    rebuild_request_counters()
+
+
+# ordered list of (version, description, migration function). only ever append to this list
+MIGRATIONS = [
+    (1, 'indexed login fingerprints on hospital', add_login_fingerprints),
+    (2, 'composite indexes on shifts and requests', add_shift_request_indexes),
+    (3, 'request counters on shifts', add_request_counters),
+    (4, 'parsed start/end timestamps on shifts', add_shift_timestamps),
+    (5, 'recurring shift series', add_shift_series),
+    (6, 'index shifts by posting time for digests', add_shift_create_index),
+    (7, 'closed timestamps on shifts for the analytics rollups', add_shift_closed_timestamps),
+    (8, 'full-text search index on shifts', add_shift_search_index),
+    (9, 'index requests by hospital for the API', add_request_hospital_index),
+    (10, 'one subscription per email and filter', add_subscription_unique_index),
+    (11, 'never reuse archived shift and request ids on sqlite', autoincrement_live_ids),
+    (12, 'request counters only count requests made while the shift was open', recount_open_requests),
+]
+
+
+def upgrade_db():
+    """
+    creates any missing tables and applies the schema migrations that haven't been run against the database yet.
+
+    returns the migrations that were applied
+    """
+    db.create_all()
+    applied = {row.version for row in SchemaVersion.query.all()}
+    newly_applied = []
+    for version, description, migration in MIGRATIONS:
+        if version in applied:
+            continue
+        migration()
+        db.session.add(SchemaVersion(version=version, description=description, applied_dt_tm=datetime.now()))
+        db.session.commit()
+        newly_applied.append((version, description))
+    return newly_applied
+
+
+@app.cli.command('upgrade-db')
+def upgrade_db_command():
+    """
+    brings the database schema up to date (run on every deploy, see the release entry in the Procfile)
+    """
+    newly_applied = upgrade_db()
+    for version, description in newly_applied:
+        print(f'applied migration {version}: {description}')
+    if not newly_applied:
+        print('database schema is up to date')
+
+
+def credential_fingerprint(password):
+    """
+    keyed HMAC of a login. unlike the salted password hash it's deterministic, so it can be looked up with an index
+    """
+    key = (app.config['CREDENTIAL_KEY'] or '').encode()
+    return hmac.new(key, password.encode(), hashlib.sha256).hexdigest()
+
+
+legacy_login_cutoff_dt_tm = None
+
+
+def legacy_logins_allowed():
+    """
+    whether hospitals without login fingerprints can still log in through the legacy scan, which is only allowed for
+    LEGACY_LOGIN_GRACE_DAYS after the fingerprint migration was applied
+    """
+    global legacy_login_cutoff_dt_tm
+    if legacy_login_cutoff_dt_tm is None:
+        migration = SchemaVersion.query.get(1)
+        if migration is None:
+            return True
+        legacy_login_cutoff_dt_tm = migration.applied_dt_tm + timedelta(days=app.config['LEGACY_LOGIN_GRACE_DAYS'])
+    return datetime.now() < legacy_login_cutoff_dt_tm
+
+
+def match_login(password, login_types):
+    """
+    returns the hospital whose login of one of login_types ('admin', 'staff') matches the password and which type it
+    matched, or (None, None).
+
+    hospitals are found through the fingerprint indexes, all of them checked before anything else, so only one
+    password hash has to be checked. during the grace period (see legacy_logins_allowed) hospitals that signed up
+    before fingerprints existed are then checked the old way and get their fingerprint filled in on a match
+    """
+    fingerprint = credential_fingerprint(password)
+    for login_type in login_types:
+        fingerprint_column = getattr(Hospital, f'{login_type}_password_fingerprint')
+        hospital = Hospital.query.filter(fingerprint_column == fingerprint).first()
+        if hospital and check_password_hash(getattr(hospital, f'{login_type}_password'), password):
+            return hospital, login_type
+
+    if not legacy_logins_allowed():
+        return None, None
+    for login_type in login_types:
+        fingerprint_column = getattr(Hospital, f'{login_type}_password_fingerprint')
+        legacy_hospitals = Hospital.query.filter(fingerprint_column.is_(None))
+        for hospital in legacy_hospitals:
+            if check_password_hash(getattr(hospital, f'{login_type}_password'), password):
+                setattr(hospital, f'{login_type}_password_fingerprint', fingerprint)
+                db.session.commit()
+                return hospital, login_type
+    return None, None
+
+
+@app.cli.command('reset-login')
+@click.argument('hospital_id', type=int)
+@click.argument('login_type', type=click.Choice(['admin', 'staff']))
+def reset_login_command(hospital_id, login_type):
+    """
+    gives a hospital a new random admin or staff login and prints it, e.g. for a hospital whose login predates the
+    fingerprints and wasn't used during the grace period
+    """
+    hospital = Hospital.query.get(hospital_id)
+    if hospital is None:
+        raise click.ClickException(f'there is no hospital {hospital_id}')
+    password = secrets.token_urlsafe(9)
+    setattr(hospital, f'{login_type}_password', generate_password_hash(password, method='pbkdf2:sha256', salt_length=8))
+    setattr(hospital, f'{login_type}_password_fingerprint', credential_fingerprint(password))
+    db.session.commit()
+    print(f'new {login_type} login for hospital {hospital_id}: {password}')
+
+
+class HospitalSnapshot(UserMixin):
+    """
+    read-only copy of a hospital's public info (no login hashes) that can be shared between requests and threads.
+    it's what templates and the login manager get from get_hospital
+    """
+    columns = ('id', 'hospital_name', 'admin_name', 'admin_email', 'created_date')
+
+    def __init__(self, hospital):
+        for column in self.columns:
+            object.__setattr__(self, column, getattr(hospital, column))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('hospital snapshots are read-only')
+
+
+class LRUCache:
+    """
+    small thread-safe per-process LRU cache. entries expire after ttl seconds so changes made by other processes are
+    eventually picked up, and invalidate() drops an entry right away after a change made by this one
+    """
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key=None):
+        """
+        drops one entry from the cache, or everything if no key is given
+        """
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
+hospital_cache = LRUCache(app.config['HOSPITAL_CACHE_SIZE'], app.config['HOSPITAL_CACHE_TTL'])
+board_cache = LRUCache(app.config['BOARD_CACHE_SIZE'], app.config['BOARD_CACHE_TTL'])
+
+
+def get_hospital(hospital_id):
+    """
+    returns the read-only snapshot of a hospital (or None if it doesn't exist), only going to the db on a cache miss
+    """
+    try:
+        hospital_id = int(hospital_id)
+    except (TypeError, ValueError):
+        return None
+    snapshot = hospital_cache.get(hospital_id)
+    if snapshot is None:
+        hospital = Hospital.query.get(hospital_id)
+        if hospital is None:
+            return None
+        snapshot = HospitalSnapshot(hospital)
+        hospital_cache.put(hospital_id, snapshot)
+    return snapshot
+
+
+def board_version(hospital_id):
+    """
+    the (version, last change time) of a hospital's shift board
+    """
+    version = db.session.query(BoardVersion.version, BoardVersion.updated_dt_tm) \
+        .filter(BoardVersion.hospital_id == hospital_id) \
+        .first()
+    return version if version else (0, None)
+
+
+def bump_board_version(hospital_id):
+    """
+    marks the hospital's shift board as changed. call it in the same transaction as the change
+    """
+    cur_dt = datetime.now()
+    bumped = db.session.query(BoardVersion) \
+        .filter(BoardVersion.hospital_id == hospital_id) \
+        .update({BoardVersion.version: BoardVersion.version + 1, BoardVersion.updated_dt_tm: cur_dt},
+                synchronize_session=False)
+    if not bumped:
+        db.session.add(BoardVersion(hospital_id=hospital_id, version=1, updated_dt_tm=cur_dt))
+
+
+def shift_event_payload(shift):
+    """
+    what the live feed sends about a posted or updated shift, enough for a page to draw its row
+    """
+    return {
+        'shift_id': shift.shift_id,
+        'area': shift.area,
+        'role': shift.role,
+        'date': str(shift.date.date() if isinstance(shift.date, datetime) else shift.date),
+        'start_time': shift.start_time,
+        'end_time': shift.end_time,
+        'comments': shift.comments,
+        'contact_name': shift.contact_name,
+        'contact_email': shift.contact_email,
+        'request_count': shift.request_count or 0,
+        'request_url': url_for('request_shift', id=shift.shift_id),
+        'details_url': url_for('request_detail', id=shift.shift_id),
+        'edit_url': url_for('edit_shift', id=shift.shift_id),
+        'remove_url': url_for('remove_shift', id=shift.shift_id)
+    }
+
+
+def publish_shift_event(hospital_id, event_type, shift_id=None, payload=None):
+    """
+    adds an event to the hospital's live feed. call it in the same transaction as the change so the feed only ever
+    shows committed changes. event_type 'board-changed' tells pages to reload (used by the bulk paths)
+    """
+    payload = dict(payload or {}, shift_id=shift_id)
+    db.session.add(ShiftEvent(hospital_id=hospital_id, event_type=event_type, shift_id=shift_id,
+                              payload=json.dumps(payload), create_dt_tm=datetime.now()))
+
+
+class ShiftEventBroker:
+    """
+    fans the shift_event table out to the live feed connections in this process.
+
+    one thread per process polls for new events every EVENT_POLL_SECONDS (however many browsers are connected) and
+    hands each one to the queues of that hospital's listeners. since it reads from the db it sees changes made by every
+    worker process
+    """
+    def __init__(self):
+        self.listeners = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def subscribe(self, hospital_id, limit):
+        """
+        a queue that gets the hospital's new events, or None if this process already has limit listeners
+        """
+        listener = queue.Queue(maxsize=1000)
+        with self.lock:
+            if sum(len(listeners) for listeners in self.listeners.values()) >= limit:
+                return None
+            self.listeners.setdefault(hospital_id, set()).add(listener)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='shift-event-broker', daemon=True)
+                self.thread.start()
+        return listener
+
+    def unsubscribe(self, hospital_id, listener):
+        with self.lock:
+            self.listeners.get(hospital_id, set()).discard(listener)
+
+    def run(self):
+        table = ShiftEvent.__table__
+        with db.engine.connect() as connection:
+            last_event_id = connection.execute(func.max(table.c.event_id).select()).scalar() or 0
+        while True:
+            time.sleep(app.config['EVENT_POLL_SECONDS'])
+            try:
+                with db.engine.connect() as connection:
+                    events = connection.execute(
+                        table.select().where(table.c.event_id > last_event_id).order_by(table.c.event_id).limit(500)
+                    ).fetchall()
+            except Exception:
+                app.logger.exception('could not read shift events')
+                continue
+            for event in events:
+                last_event_id = event.event_id
+                with self.lock:
+                    listeners = list(self.listeners.get(event.hospital_id, ()))
+                for listener in listeners:
+                    try:
+                        listener.put_nowait(event)
+                    except queue.Full:
+                        pass
+
+
+shift_event_broker = ShiftEventBroker()
+
+
+def format_shift_event(event):
+    """
+    an event in Server-Sent Events wire format
+    """
+    return f"id: {event.event_id}\nevent: {event.event_type}\ndata: {event.payload}\n\n"
+
+
+# query args that change on every DataTables call without changing the data
+UNCACHED_ARGS = ('draw', '_')
+
+
+def board_response(hospital_id, build, make_response=None):
+    """
+    serves a public shift board page or data page.
+
+    build() does the actual querying/rendering. its result is cached by the hospital's board version (plus today's
+    date, since the open board drops past shifts, and whether an admin is logged in, since the nav differs), so it
+    only reruns after something on the board changed.
+    make_response turns the cached result into the response, and clients that already have the current version
+    get a 304
+    """
+    version, updated_dt_tm = board_version(hospital_id)
+    cache_args = tuple(sorted((key, value) for key, value in request.args.items(multi=True)
+                              if key not in UNCACHED_ARGS))
+    # what build() can cache beyond its own result (like datatables_page's total) is keyed on this
+    g.board_version_key = (request.endpoint, str(hospital_id), version, date.today().isoformat())
+    cache_key = g.board_version_key + (current_user.is_authenticated, cache_args)
+    etag = hashlib.sha1(repr(cache_key).encode()).hexdigest()
+
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        body = board_cache.get(cache_key)
+        if body is None:
+            body = build()
+            board_cache.put(cache_key, body)
+        response = app.make_response(make_response(body) if make_response else body)
+    response.set_etag(etag)
+    if updated_dt_tm:
+        response.last_modified = updated_dt_tm
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.cli.command('check-request-counts')
+@click.option('--rebuild', is_flag=True, help='recompute every shift\'s counters from the requests table')
+def check_request_counts_command(rebuild):
+    """
+    lists the shifts whose request counters don't match the requests table, and optionally rebuilds them
+    """
+    request_count, last_request_dt_tm = request_counter_values()
+    mismatched = db.session.query(Shifts.shift_id, Shifts.request_count, request_count.label('actual_count')) \
+        .filter(or_(Shifts.request_count != request_count,
+                    Shifts.last_request_dt_tm != last_request_dt_tm,
+                    Shifts.last_request_dt_tm.is_(None) != last_request_dt_tm.is_(None))) \
+        .all()
+    for shift_id, stored_count, actual_count in mismatched:
+        print(f'shift {shift_id}: request_count is {stored_count}, should be {actual_count}')
+    print(f'{len(mismatched)} shift(s) with out of date request counters')
+    if rebuild:
+        rebuild_request_counters()
+        db.session.commit()
+        print('request counters rebuilt')
+
+
+def queue_email(to_addrs, subject, contents):
+    """
+    adds an email to the outbox so the request doesn't have to wait on the mail server. it's sent by the background worker
+    once the caller commits. every recipient is listed in the To header, so people who shouldn't see each other's
+    addresses need an email each. nothing is queued when none of the addresses are set (e.g. EMAIL isn't configured)
+    """
+    if to_addrs is None or isinstance(to_addrs, str):
+        to_addrs = [to_addrs]
+    to_addrs = [addr for addr in to_addrs if addr]
+    if not to_addrs:
+        return
+    cur_dt = datetime.now()
+    db.session.add(Outbox(
+        to_addrs=", ".join(to_addrs),
+        subject=subject,
+        body=contents,
+        status='Queued',
+        attempts=0,
+        next_attempt_dt_tm=cur_dt,
+        create_dt_tm=cur_dt
+    ))
+
+
+class OutboxSender:
+    """
+    keeps one authenticated SMTP connection open across batches and reconnects when the server has dropped it
+    """
+    def __init__(self):
+        self.connection = None
+
+    def connect(self):
+        if self.connection is not None:
+            try:
+                if self.connection.noop()[0] == 250:
+                    return self.connection
+            except smtplib.SMTPException:
+                pass
+            self.close()
+        self.connection = smtplib.SMTP(smtp_host, smtp_port)
+        if smtp_starttls:
+            self.connection.starttls()
+        if email_password:
+            self.connection.login(email_address, email_password)
+        return self.connection
+
+    def send(self, email):
+        # EmailMessage encodes the headers and body as UTF-8 where needed, so names like José go through
+        message = EmailMessage()
+        message['Subject'] = email.subject
+        if email_address:
+            message['From'] = email_address
+        message['To'] = email.to_addrs
+        message.set_content(email.body)
+        send_start = time.perf_counter()
+        try:
+            self.connect().send_message(message, from_addr=email_address, to_addrs=email.to_addrs.split(", "))
+        finally:
+            metrics.observe('smtp_send_seconds', time.perf_counter() - send_start, LATENCY_BUCKETS)
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.connection = None
+
+
+def send_outbox_batch(sender):
+    """
+    sends the next batch of due emails over the sender's connection and returns how many were attempted.
+
+    failed emails are retried with exponential backoff until OUTBOX_MAX_ATTEMPTS, after which they're marked Failed.
+    the batch is claimed (its next attempt pushed back OUTBOX_LEASE_SECONDS) before anything is sent, and each email's
+    outcome is committed as soon as it's known, so one bad email can't get the ones before it sent again.
+    bodies are cleared once sent since some of them (e.g. the signup email) contain logins
+    """
+    cur_dt = datetime.now()
+    batch = Outbox.query \
+        .filter(Outbox.status == 'Queued', Outbox.next_attempt_dt_tm <= cur_dt) \
+        .order_by(Outbox.next_attempt_dt_tm, Outbox.email_id) \
+        .limit(app.config['OUTBOX_BATCH_SIZE']) \
+        .with_for_update(skip_locked=True) \
+        .all()
+    for email in batch:
+        email.attempts += 1
+        email.next_attempt_dt_tm = cur_dt + timedelta(seconds=app.config['OUTBOX_LEASE_SECONDS'])
+    db.session.commit()
+
+    for email in batch:
+        try:
+            sender.send(email)
+        except Exception as error:
+            sender.close()
+            email.last_error = str(error)[:1000]
+            if email.attempts >= app.config['OUTBOX_MAX_ATTEMPTS']:
+                email.status = 'Failed'
+            else:
+                backoff = app.config['OUTBOX_RETRY_SECONDS'] * 2 ** (email.attempts - 1)
+                email.next_attempt_dt_tm = datetime.now() + timedelta(seconds=backoff)
+        else:
+            email.status = 'Sent'
+            email.sent_dt_tm = datetime.now()
+            email.body = None
+        db.session.commit()
+    return len(batch)
+
+
+# (function, config key of its interval in seconds) for the jobs the background worker runs between outbox batches
+PERIODIC_JOBS = []
+
+
+def periodic_job(interval_config_key):
+    """
+    registers a function for the background worker to run every app.config[interval_config_key] seconds
+    """
+    def register(job):
+        PERIODIC_JOBS.append((job, interval_config_key))
+        return job
+    return register
+
+
+def run_periodic_jobs(last_runs):
+    """
+    runs the periodic jobs that are due. last_runs maps each job to when it last ran
+    """
+    for job, interval_config_key in PERIODIC_JOBS:
+        if time.monotonic() - last_runs.get(job, float('-inf')) < app.config[interval_config_key]:
+            continue
+        last_runs[job] = time.monotonic()
+        try:
+            job()
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            app.logger.exception(f'periodic job {job.__name__} failed')
+
+
+def run_worker(stop_event=None):
+    """
+    sends the outbox and runs the periodic jobs until stop_event is set (or forever), sleeping between polls when
+    there's nothing due
+    """
+    sender = OutboxSender()
+    last_runs = {}
+    with app.app_context():
+        try:
+            while stop_event is None or not stop_event.is_set():
+                try:
+                    sent = send_outbox_batch(sender)
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception('outbox batch failed')
+                    sent = 0
+                run_periodic_jobs(last_runs)
+                if sent < app.config['OUTBOX_BATCH_SIZE']:
+                    time.sleep(app.config['OUTBOX_POLL_SECONDS'])
+        finally:
+            sender.close()
+            db.session.remove()
+
+
+@app.cli.command('worker')
+def worker_command():
+    """
+    runs the background worker in the foreground (see the worker entry in the Procfile)
+    """
+    run_worker()
+
+
+class DatabaseSession(CallbackDict, SessionMixin):
+    """
+    session data loaded from the web_session table
+    """
+    def __init__(self, initial=None, session_id=None, expiry_dt_tm=None):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.session_id = session_id
+        self.expiry_dt_tm = expiry_dt_tm
+        self.modified = False
+
+
+class DatabaseSessionInterface(SessionInterface):
+    """
+    keeps sessions in the web_session table with only a signed session id in the cookie.
+
+    a row is only written when the session changes (or its expiry needs pushing back), so visitors whose session never
+    gets any data don't cost a write. expired rows are deleted in batches by sweep_expired_sessions
+    """
+    serializer = TaggedJSONSerializer()
+    salt = 'web-session'
+
+    def get_signer(self, app):
+        return Signer(app.secret_key, salt=self.salt)
+
+    def open_session(self, app, request):
+        if not app.secret_key:
+            return None
+        signed_id = request.cookies.get(app.session_cookie_name)
+        if signed_id:
+            try:
+                session_id = self.get_signer(app).unsign(signed_id).decode()
+            except BadSignature:
+                session_id = None
+            if session_id:
+                table = WebSession.__table__
+                with db.engine.connect() as connection:
+                    row = connection.execute(
+                        table.select().where(table.c.session_id == session_id)
+                    ).first()
+                if row is not None and row.expiry_dt_tm > datetime.now():
+                    return DatabaseSession(self.serializer.loads(row.data), session_id, row.expiry_dt_tm)
+        return DatabaseSession()
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        table = WebSession.__table__
+
+        if not session:
+            if session.session_id and session.modified:
+                with db.engine.begin() as connection:
+                    connection.execute(table.delete().where(table.c.session_id == session.session_id))
+                response.delete_cookie(app.session_cookie_name, domain=domain, path=path)
+            return
+
+        cur_dt = datetime.now()
+        ttl = timedelta(seconds=app.config['SESSION_TTL'])
+        expiry_is_stale = session.expiry_dt_tm is not None and session.expiry_dt_tm - cur_dt < ttl / 2
+        if not session.modified and not expiry_is_stale:
+            return
+
+        values = {'data': self.serializer.dumps(dict(session)), 'expiry_dt_tm': cur_dt + ttl}
+        with db.engine.begin() as connection:
+            if session.session_id:
+                updated = connection.execute(
+                    table.update().where(table.c.session_id == session.session_id).values(**values)
+                ).rowcount
+            else:
+                updated = 0
+            if not updated:
+                session.session_id = secrets.token_urlsafe(32)
+                connection.execute(table.insert().values(session_id=session.session_id, **values))
+
+        response.set_cookie(app.session_cookie_name, self.get_signer(app).sign(session.session_id).decode(),
+                            expires=self.get_expiration_time(app, session), httponly=self.get_cookie_httponly(app),
+                            domain=domain, path=path, secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app))
+
+
+app.session_interface = DatabaseSessionInterface()
+
+
+@periodic_job('EVENT_PRUNE_SECONDS')
+def prune_shift_events():
+    """
+    deletes live feed events older than EVENT_RETENTION_SECONDS. browsers only need them to catch up after reconnecting
+    """
+    cutoff = datetime.now() - timedelta(seconds=app.config['EVENT_RETENTION_SECONDS'])
+    db.session.query(ShiftEvent).filter(ShiftEvent.create_dt_tm < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+
+
+@periodic_job('SESSION_SWEEP_SECONDS')
+def sweep_expired_sessions():
+    """
+    deletes expired sessions in batches of SESSION_SWEEP_BATCH_SIZE
+    """
+    batch_size = app.config['SESSION_SWEEP_BATCH_SIZE']
+    while True:
+        expired_ids = db.session.query(WebSession.session_id) \
+            .filter(WebSession.expiry_dt_tm < datetime.now()) \
+            .limit(batch_size)
+        deleted = db.session.query(WebSession) \
+            .filter(WebSession.session_id.in_(expired_ids.subquery())) \
+            .delete(synchronize_session=False)
+        db.session.commit()
+        if deleted < batch_size:
+            return
+
+
+def expiry_summary(shifts):
+    """
+    the (subject, contents) of a hospital's email about its shifts that expired without being filled
+    """
+    shifts = sorted(shifts, key=lambda shift: (shift.date, shift.start_dt_tm or datetime.min))
+    listed = shifts[:app.config['EXPIRY_SUMMARY_MAX_SHIFTS']]
+    lines = [f"- {shift.date} {shift.start_time}-{shift.end_time}: {shift.area}, {shift.role} "
+             f"({shift.request_count} request{'s' if shift.request_count != 1 else ''})" for shift in listed]
+    if len(shifts) > len(listed):
+        lines.append(f"...and {len(shifts) - len(listed)} more")
+    subject = f"{len(shifts)} shift{'s' if len(shifts) != 1 else ''} expired without being filled"
+    contents = "These shifts have passed without being filled, so they've been closed along with any requests " \
+               "still waiting on them:\n" + "\n".join(lines) + "\nFrom,\nYour trusty pals at Shift Helper"
+    return subject, contents
+
+
+@periodic_job('EXPIRY_SECONDS')
+def expire_past_shifts():
+    """
+    marks shifts dated before today that are still Posted or Requested as Expired, along with their pending requests.
+
+    works through EXPIRY_BATCH_SIZE shifts at a time with bulk UPDATEs. with EXPIRY_SUMMARY_EMAILS set each hospital
+    admin gets one email listing their expired shifts. returns how many shifts were expired
+    """
+    batch_size = app.config['EXPIRY_BATCH_SIZE']
+    today = date.today()
+    expired_by_hospital = {}
+    expired = 0
+    while True:
+        shift_ids = [row.shift_id for row in db.session.query(Shifts.shift_id)
+                     .filter(Shifts.status.in_(OPEN_SHIFT_STATUSES), Shifts.date < today)
+                     .order_by(Shifts.shift_id)
+                     .limit(batch_size)]
+        if shift_ids:
+            # the status is checked again so a shift approved since it was picked keeps its approval
+            expired += db.session.query(Shifts) \
+                .filter(Shifts.shift_id.in_(shift_ids), Shifts.status.in_(OPEN_SHIFT_STATUSES)) \
+                .update({Shifts.status: 'Expired', Shifts.closed_dt_tm: datetime.now()}, synchronize_session=False)
+            expired_shifts = db.session.query(Shifts) \
+                .filter(Shifts.shift_id.in_(shift_ids), Shifts.status == 'Expired')
+            db.session.query(Requests) \
+                .filter(Requests.shift_id.in_(expired_shifts.with_entities(Shifts.shift_id).subquery()),
+                        Requests.status == 'Requested') \
+                .update({Requests.status: 'Expired'}, synchronize_session=False)
+            if app.config['EXPIRY_SUMMARY_EMAILS']:
+                for shift in expired_shifts.with_entities(Shifts.hospital_id, Shifts.date, Shifts.start_dt_tm,
+                                                          Shifts.start_time, Shifts.end_time, Shifts.area, Shifts.role,
+                                                          Shifts.request_count):
+                    expired_by_hospital.setdefault(shift.hospital_id, []).append(shift)
+            db.session.commit()
+        if len(shift_ids) < batch_size:
+            break
+
+    for hospital_id, shifts in expired_by_hospital.items():
+        hospital = get_hospital(hospital_id)
+        if hospital and hospital.admin_email:
+            queue_email([hospital.admin_email], *expiry_summary(shifts))
+    db.session.commit()
+    return expired
+
+
+def archive_rows(model, archive_model, criteria, archived_dt_tm):
+    """
+    copies the model's rows matching criteria into its archive table with one INSERT ... SELECT
+    """
+    columns = list(model.__table__.columns)
+    rows = db.session.query(*columns, literal(archived_dt_tm, db.TIMESTAMP)).filter(criteria)
+    db.session.execute(archive_model.__table__.insert()
+                       .from_select([column.name for column in columns] + ['archived_dt_tm'], rows.statement))
+
+
+@periodic_job('ARCHIVE_SECONDS')
+def archive_past_shifts():
+    """
+    moves shifts dated more than ARCHIVE_AFTER_DAYS ago, and their requests, into the archive tables.
+
+    each batch of ARCHIVE_BATCH_SIZE shifts is copied and deleted set-based in one transaction, so a shift is always
+    in exactly one of the two tables. returns how many shifts were archived
+    """
+    batch_size = app.config['ARCHIVE_BATCH_SIZE']
+    cutoff = date.today() - timedelta(days=app.config['ARCHIVE_AFTER_DAYS'])
+    archived = 0
+    while True:
+        shift_ids = [row.shift_id for row in db.session.query(Shifts.shift_id)
+                     .filter(Shifts.date < cutoff)
+                     .order_by(Shifts.shift_id)
+                     .limit(batch_size)]
+        if shift_ids:
+            archived_dt_tm = datetime.now()
+            archive_rows(Shifts, ShiftsArchive, Shifts.shift_id.in_(shift_ids), archived_dt_tm)
+            archive_rows(Requests, RequestsArchive, Requests.shift_id.in_(shift_ids), archived_dt_tm)
+            db.session.query(Requests).filter(Requests.shift_id.in_(shift_ids)).delete(synchronize_session=False)
+            db.session.query(Shifts).filter(Shifts.shift_id.in_(shift_ids)).delete(synchronize_session=False)
+            db.session.commit()
+            archived += len(shift_ids)
+        if len(shift_ids) < batch_size:
+            return archived
+
+
+def with_archive(build_query):
+    """
+    build_query(shifts_model, requests_model) run against the live tables and again against the archive tables, as
+    one UNION ALL query. both have to select the same columns; the result can be filtered, ordered and paged further
+    with the live models' columns like any other query
+    """
+    return build_query(Shifts, Requests).union_all(build_query(ShiftsArchive, RequestsArchive))
+
+
+def get_watermark(job_name):
+    """
+    how far the job has gotten, or None if it has never run
+    """
+    return db.session.query(JobWatermark.watermark_dt_tm).filter(JobWatermark.job_name == job_name).scalar()
+
+
+def set_watermark(job_name, watermark_dt_tm):
+    """
+    records how far the job has gotten, in the same transaction as its work
+    """
+    db.session.merge(JobWatermark(job_name=job_name, watermark_dt_tm=watermark_dt_tm))
+
+
+def closed_shifts(columns, criteria=None, shift_days=None):
+    """
+    the given columns (by name) of the closed shifts in both the live and archive tables, optionally narrowed by
+    criteria(table), as a UNION ALL subquery.
+
+    with shift_days (a subquery of hospital_id, date pairs) each table is joined to it inside its own branch, so only
+    those days are read, through the hospital/status/date indexes
+    """
+    selects = []
+    for table in (Shifts.__table__, ShiftsArchive.__table__):
+        where = table.c.status.in_(CLOSED_SHIFT_STATUSES)
+        if criteria is not None:
+            where = and_(where, criteria(table))
+        shifts_select = select([table.c[column] for column in columns]).where(where)
+        if shift_days is not None:
+            shifts_select = shifts_select.select_from(shift_days.join(
+                table, and_(table.c.hospital_id == shift_days.c.hospital_id, table.c.date == shift_days.c.date)))
+        selects.append(shifts_select)
+    return union_all(*selects).alias('closed_shifts')
+
+
+def seconds_between(start, end):
+    """
+    end - start in seconds, as a SQL expression
+    """
+    if db.engine.dialect.name == 'sqlite':
+        return (func.julianday(end) - func.julianday(start)) * 86400
+    return func.extract('epoch', end - start)
+
+
+def rollup_rows(shift_days=None):
+    """
+    the rollup rows computed from the closed shifts with one GROUP BY, for every day or only the (hospital_id, date)
+    pairs in the shift_days subquery
+    """
+    shifts = closed_shifts(['hospital_id', 'date', 'area', 'role', 'status', 'request_count', 'create_dt_tm',
+                            'approved_dt_tm'], shift_days=shift_days)
+    filled = shifts.c.status == 'Approved'
+    timed = and_(filled, shifts.c.create_dt_tm.isnot(None), shifts.c.approved_dt_tm.isnot(None))
+    area, role = func.coalesce(shifts.c.area, ''), func.coalesce(shifts.c.role, '')
+    rows = select([shifts.c.hospital_id, shifts.c.date, area, role,
+                   func.sum(case([(filled, 1)], else_=0)),
+                   func.sum(case([(shifts.c.status == 'Expired', 1)], else_=0)),
+                   func.sum(case([(shifts.c.status == 'Removed', 1)], else_=0)),
+                   func.sum(shifts.c.request_count),
+                   func.sum(case([(timed, seconds_between(shifts.c.create_dt_tm, shifts.c.approved_dt_tm))],
+                                 else_=0)),
+                   func.sum(case([(timed, 1)], else_=0))]) \
+        .where(and_(shifts.c.hospital_id.isnot(None), shifts.c.date.isnot(None))) \
+        .group_by(shifts.c.hospital_id, shifts.c.date, area, role)
+    return rows
+
+
+@periodic_job('ROLLUP_SECONDS')
+def refresh_shift_rollups(rebuild=False):
+    """
+    brings the daily rollups up to date with the shifts closed since the last refresh.
+
+    only the hospital days that had a shift close since the watermark are deleted and recomputed, set-based, in one
+    transaction with the new watermark. the first refresh (or rebuild) computes every day
+    """
+    cutoff = datetime.now() - timedelta(seconds=app.config['ROLLUP_DELAY_SECONDS'])
+    watermark = None if rebuild else get_watermark('shift_rollup')
+    rollup = ShiftRollup.__table__
+    if watermark is None:
+        shift_days = None
+        db.session.execute(rollup.delete())
+    else:
+        changed_days = [select([table.c.hospital_id, table.c.date])
+                        .where(and_(table.c.status.in_(CLOSED_SHIFT_STATUSES), table.c.closed_dt_tm > watermark,
+                                    table.c.closed_dt_tm <= cutoff))
+                        for table in (Shifts.__table__, ShiftsArchive.__table__)]
+        shift_days = union(*changed_days).alias('shift_days')
+        db.session.execute(rollup.delete().where(exists().where(and_(shift_days.c.hospital_id == rollup.c.hospital_id,
+                                                                     shift_days.c.date == rollup.c.shift_date))))
+    db.session.execute(rollup.insert().from_select(
+        ['hospital_id', 'shift_date', 'area', 'role', 'shifts_filled', 'shifts_expired', 'shifts_removed', 'requests',
+         'fill_seconds', 'timed_fills'],
+        rollup_rows(shift_days)))
+    set_watermark('shift_rollup', cutoff)
+    db.session.commit()
+
+
+@app.cli.command('refresh-rollups')
+@click.option('--rebuild', is_flag=True, help='recompute every day instead of only the ones changed since last time')
+def refresh_rollups_command(rebuild):
+    """
+    refreshes the analytics rollups now instead of waiting for the background worker
+    """
+    refresh_shift_rollups(rebuild=rebuild)
+    print(f'{ShiftRollup.query.count()} rollup rows')
+
+
+def rollup_summary(rollups, key):
+    """
+    totals the rollup rows by key(row) into fill rate, average time to fill (hours) and request volume, sorted by key
+    """
+    totals = {}
+    for row in rollups:
+        total = totals.setdefault(key(row), dict(filled=0, expired=0, removed=0, requests=0, fill_seconds=0.0,
+                                                 timed_fills=0))
+        total['filled'] += row.shifts_filled
+        total['expired'] += row.shifts_expired
+        total['removed'] += row.shifts_removed
+        total['requests'] += row.requests or 0
+        total['fill_seconds'] += row.fill_seconds or 0
+        total['timed_fills'] += row.timed_fills
+    summary = []
+    for group, total in sorted(totals.items()):
+        resolved = total['filled'] + total['expired']
+        summary.append(dict(
+            group=group, filled=total['filled'], expired=total['expired'], removed=total['removed'],
+            requests=total['requests'],
+            fill_rate=total['filled'] / resolved if resolved else None,
+            fill_hours=total['fill_seconds'] / total['timed_fills'] / 3600 if total['timed_fills'] else None
+        ))
+    return summary
+
+
+def digest_contents(subscription, new_shifts):
+    """
+    the text of a new shift digest email
+    """
+    shift_lines = "\n".join(f"- {shift.date} {shift.start_time}-{shift.end_time}: {shift.role} in {shift.area}"
+                            f"{' (' + shift.comments + ')' if shift.comments else ''}"
+                            for shift in new_shifts)
+    links = f"\nSee all open shifts: {app.config['BASE_URL']}/shifts?hospital_id={subscription.hospital_id}\n" \
+            f"Stop these emails: {app.config['BASE_URL']}/unsubscribe?token={subscription.token}\n"
+    return f"New shifts were posted that match your alerts:\n\n{shift_lines}\n{links}\n" \
+           "From,\nYour trusty pals at Shift Helper"
+
+
+@periodic_job('DIGEST_SECONDS')
+def send_shift_digests():
+    """
+    queues one email per subscriber listing the shifts posted since the last digest that match their subscription.
+
+    new shifts are grouped by (hospital, area, role) once, so each subscriber only costs a few dict lookups and the
+    work scales with the digests sent rather than with shifts x subscribers. nothing is sent without BASE_URL, since
+    every digest has to carry its unsubscribe link
+    """
+    if not app.config['BASE_URL']:
+        app.logger.warning('BASE_URL is not set, so no shift digests are being sent')
+        return 0
+    cutoff = datetime.now().replace(microsecond=0) - timedelta(seconds=app.config['DIGEST_DELAY_SECONDS'])
+    watermark = get_watermark('shift_digest')
+    if watermark is None:
+        set_watermark('shift_digest', cutoff)
+        return 0
+
+    new_shifts = db.session.query(Shifts) \
+        .filter(Shifts.create_dt_tm > watermark, Shifts.create_dt_tm <= cutoff, Shifts.status == 'Posted',
+                Shifts.date >= date.today()) \
+        .order_by(Shifts.date, Shifts.start_dt_tm, Shifts.shift_id) \
+        .all()
+    shift_groups = {}
+    for shift in new_shifts:
+        area = (shift.area or '').strip().lower()
+        for key in ((shift.hospital_id, area, shift.role), (shift.hospital_id, area, None),
+                    (shift.hospital_id, None, shift.role), (shift.hospital_id, None, None)):
+            shift_groups.setdefault(key, []).append(shift)
+
+    digests_sent = 0
+    if new_shifts:
+        subscribers = Subscription.query \
+            .filter(Subscription.hospital_id.in_({shift.hospital_id for shift in new_shifts}),
+                    Subscription.status == 'Active')
+        for subscription in subscribers:
+            area = subscription.area or None
+            matching_shifts = shift_groups.get((subscription.hospital_id, area, subscription.role or None))
+            if matching_shifts:
+                queue_email(subscription.email, f"{len(matching_shifts)} new shift(s) posted on Shift Helper",
+                            digest_contents(subscription, matching_shifts))
+                subscription.last_digest_dt_tm = cutoff
+                digests_sent += 1
+
+    set_watermark('shift_digest', cutoff)
+    db.session.commit()
+    return digests_sent
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Metrics:
+    """
+    counters and histograms kept in memory and served in the Prometheus text format by /metrics.
+
+    each process keeps its own, so every gunicorn worker has to be scraped (they're labelled by pid)
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, labels=None, amount=1):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, buckets, labels=None):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': buckets, 'counts': [0] * len(buckets), 'sum': 0,
+                                                    'count': 0}
+            for index, upper_bound in enumerate(buckets):
+                if value <= upper_bound:
+                    histogram['counts'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    @staticmethod
+    def format_labels(labels, extra=()):
+        labels = (('pid', str(os.getpid())),) + tuple(labels) + tuple(extra)
+        return "{" + ",".join(f'{name}="{str(value)}"' for name, value in labels) + "}"
+
+    def render(self, gauges=None):
+        """
+        everything recorded so far (plus the given {(name, labels): value} gauges) as Prometheus text
+        """
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda item: item[0])
+            histograms = [(key, dict(histogram, counts=list(histogram['counts']))) for key, histogram in histograms]
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{self.format_labels(labels)} {value}")
+        for (name, labels), histogram in histograms:
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            for upper_bound, count in zip(histogram['buckets'], histogram['counts']):
+                lines.append(f"{name}_bucket{self.format_labels(labels, [('le', upper_bound)])} {count}")
+            lines.append(f"{name}_bucket{self.format_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+            lines.append(f"{name}_sum{self.format_labels(labels)} {histogram['sum']}")
+            lines.append(f"{name}_count{self.format_labels(labels)} {histogram['count']}")
+        for (name, labels), value in sorted((gauges or {}).items()):
+            if name not in typed:
+                lines.append(f"# TYPE {name} gauge")
+                typed.add(name)
+            lines.append(f"{name}{self.format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+@listens_for_engines('before_cursor_execute')
+def start_query_timer(connection, cursor, statement, parameters, context, executemany):
+    connection.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@listens_for_engines('after_cursor_execute')
+def record_query_metrics(connection, cursor, statement, parameters, context, executemany):
+    """
+    times every SQL statement, and adds it to the current request's totals (and slow request log) if there is one.
+    also notes when a request writes, for read_replica
+    """
+    duration = time.perf_counter() - connection.info['query_start'].pop()
+    endpoint = request.endpoint if has_request_context() else None
+    database = 'primary' if connection.engine is db.engine else 'replica'
+    metrics.observe('db_query_seconds', duration, LATENCY_BUCKETS, {'endpoint': endpoint or 'none', 'db': database})
+    if has_request_context() and context is not None and (context.isinsert or context.isupdate or context.isdelete):
+        g.wrote_primary = True
+    if has_request_context() and 'query_count' in g:
+        g.query_count += 1
+        g.query_seconds += duration
+        if g.slow_queries is not None:
+            g.slow_queries.append((duration, statement))
+
+
+@app.before_request
+def start_request_metrics():
+    g.request_start = time.perf_counter()
+    g.query_count = 0
+    g.query_seconds = 0.0
+    g.slow_queries = [] if app.config['SLOW_REQUEST_SECONDS'] else None
+
+
+@app.after_request
+def record_request_metrics(response):
+    """
+    records the request's latency, status and SQL totals per endpoint, and logs it with its SQL if it was slow
+    """
+    if 'request_start' not in g:
+        return response
+    duration = time.perf_counter() - g.request_start
+    labels = {'endpoint': request.endpoint or 'none', 'method': request.method}
+    metrics.inc('http_requests_total', dict(labels, status=str(response.status_code)))
+    metrics.observe('http_request_seconds', duration, LATENCY_BUCKETS, labels)
+    metrics.observe('http_request_queries', g.query_count, QUERY_COUNT_BUCKETS, labels)
+    metrics.inc('http_request_query_seconds_total', labels, g.query_seconds)
+
+    if app.config['SLOW_REQUEST_SECONDS'] and duration >= app.config['SLOW_REQUEST_SECONDS']:
+        slow_sql = "\n".join(f"  {query_duration * 1000:.1f}ms {statement}"
+                             for query_duration, statement in g.slow_queries)
+        app.logger.warning(f"slow request {request.method} {request.full_path} -> {response.status_code} "
+                           f"in {duration * 1000:.0f}ms, {g.query_count} queries "
+                           f"({g.query_seconds * 1000:.0f}ms):\n{slow_sql}")
+    return response
+
+
+READ_PRIMARY_COOKIE = 'read_primary'
+
+
+def read_replica(view):
+    """
+    decorator for read-only views: their queries go to the read replica (if there is one), unless this browser wrote
+    something in the last READ_PRIMARY_SECONDS
+    """
+    @functools.wraps(view)
+    def read_from_replica(*args, **kwargs):
+        g.read_replica = READ_PRIMARY_COOKIE not in request.cookies
+        return view(*args, **kwargs)
+    return read_from_replica
+
+
+@app.after_request
+def read_own_writes(response):
+    """
+    keeps a browser that just wrote to the database reading from the primary until the replica has caught up
+    """
+    if app.config['REPLICA_DATABASE_URL'] and g.get('wrote_primary'):
+        response.set_cookie(READ_PRIMARY_COOKIE, '1', max_age=app.config['READ_PRIMARY_SECONDS'], httponly=True,
+                            samesite='Lax')
+    return response
+
+
+@app.cli.command('sync-replica')
+def sync_replica_command():
+    """
+    copies the primary sqlite database over the replica's, for trying out the read replica locally
+    """
+    if not app.config['REPLICA_DATABASE_URL']:
+        raise click.ClickException('REPLICA_DATABASE_URL is not set')
+    primary, replica = database_engines()
+    if primary.dialect.name != 'sqlite' or replica.dialect.name != 'sqlite':
+        raise click.ClickException("only sqlite databases can be synced, use the database's own replication")
+    source, target = primary.raw_connection(), replica.raw_connection()
+    try:
+        source.connection.backup(target.connection)
+    finally:
+        source.close()
+        target.close()
+    print(f"copied {primary.url.database} to {replica.url.database}")
+
+
+def open_shifts_query(hospital_id):
+    """
+    the hospital's upcoming shifts that haven't been filled or removed
+    """
+    return db.session.query(Shifts) \
+        .filter(Shifts.status.in_(OPEN_SHIFT_STATUSES), Shifts.date >= date.today(), Shifts.hospital_id == hospital_id)
+
+
+def full_text_match(query, hospital_id, text):
+    """
+    narrows a Shifts query to the hospital's shifts whose area, role or comments contain every word of text (as a
+    word prefix, so "peds comp" finds "Peds competency"), through the full-text index.
+
+    returns the query and a relevance expression to order by (best match first). the words are pulled out of the text
+    before they go anywhere near the index, so nothing typed can break the full-text query syntax
+    """
+    words = re.findall(r'\w+', text.lower())[:10]
+    if not words:
+        return query, None
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        match = f'tenant : "h{int(hospital_id)}" AND {{area role comments}} : (' + \
+                ' AND '.join(f'"{word}"*' for word in words) + ')'
+        ranked = db.session.query(literal_column('shift_search.rowid').label('shift_id'),
+                                  literal_column('bm25(shift_search, 0, 3, 3, 1)').label('rank')) \
+            .select_from(table('shift_search')) \
+            .filter(text_clause('shift_search MATCH :match').bindparams(match=match)) \
+            .subquery()
+        return query.join(ranked, ranked.c.shift_id == Shifts.shift_id), ranked.c.rank.asc()
+    if dialect == 'postgresql':
+        ts_query = func.to_tsquery('english', ' & '.join(f'{word}:*' for word in words))
+        search_vector = literal_column('shifts.search_vector')
+        return query.filter(search_vector.op('@@')(ts_query)), func.ts_rank(search_vector, ts_query).desc()
+    # no full-text index on other databases, so every word is looked for with LIKE instead
+    for word in words:
+        pattern = f'%{word}%'
+        query = query.filter(or_(Shifts.area.ilike(pattern), Shifts.role.ilike(pattern),
+                                 Shifts.comments.ilike(pattern)))
+    return query, None
+
+
+def approved_shifts_query(hospital_id):
+    """
+    every shift the hospital has filled, archived ones included
+    """
+    return with_archive(lambda shifts, requests: db.session.query(
+        *[getattr(shifts, column.key) for column in Shifts.__table__.columns])
+        .filter(shifts.status == 'Approved', shifts.hospital_id == hospital_id))
+
+
+def open_shift_to_dict(row):
+    """
+    the JSON form of a shift on the open board
+    """
+    return {
+        'shift_id': row.shift_id,
+        'area': row.area,
+        'role': row.role,
+        'date': str(row.date),
+        'start_time': row.start_time,
+        'end_time': row.end_time,
+        'start_dt_tm': row.start_dt_tm.isoformat() if row.start_dt_tm else None,
+        'end_dt_tm': row.end_dt_tm.isoformat() if row.end_dt_tm else None,
+        'create_dt_tm': str(row.create_dt_tm),
+        'comments': row.comments,
+        'contact_name': row.contact_name,
+        'contact_email': row.contact_email,
+        'request_url': url_for('request_shift', id=row.shift_id)
+    }
+
+
+def datatables_page(query, columns, search_columns, default_order, row_to_dict):
+    """
+    runs one page of a DataTables server-side processing request against the query.
+
+    columns is the list of sortable columns in the same order as the table's columns (None for columns that can't be
+    sorted). the search term is matched against search_columns, and only the requested page is loaded. it runs
+    inside board_response, which the unfiltered total is cached by, so paging and searching don't recount the board
+    """
+    draw = request.args.get('draw', 0, type=int)
+    start = max(request.args.get('start', 0, type=int), 0)
+    length = request.args.get('length', app.config['PAGE_SIZE'], type=int)
+    if length < 1 or length > app.config['MAX_PAGE_SIZE']:
+        length = app.config['MAX_PAGE_SIZE']
+
+    total_key = g.board_version_key + ('recordsTotal',)
+    records_total = board_cache.get(total_key)
+    if records_total is None:
+        records_total = query.order_by(None).count()
+        board_cache.put(total_key, records_total)
+
+    search_term = request.args.get('search[value]', '').strip()
+    if search_term:
+        pattern = f"%{search_term}%"
+        query = query.filter(or_(*[column.ilike(pattern) for column in search_columns]))
+        records_filtered = query.order_by(None).count()
+    else:
+        records_filtered = records_total
+
+    order_column = request.args.get('order[0][column]', type=int)
+    if order_column is not None and 0 <= order_column < len(columns) and columns[order_column] is not None:
+        column = columns[order_column]
+        direction = column.desc() if request.args.get('order[0][dir]') == 'desc' else column.asc()
+        query = query.order_by(direction, *default_order)
+    else:
+        query = query.order_by(*default_order)
+
+    rows = query.offset(start).limit(length).all()
+    return dict(recordsTotal=records_total, recordsFiltered=records_filtered, data=[row_to_dict(row) for row in rows])
+
+
+def datatables_response(page):
+    """
+    the JSON response for a page from datatables_page, echoing back the request's draw counter
+    """
+    return jsonify(draw=request.args.get('draw', 0, type=int), **page)
+
+
+IMPORT_REQUIRED_COLUMNS = ['area', 'role', 'date', 'start_time', 'end_time', 'contact_name', 'contact_email']
+EMAIL_PATTERN = r'^[^@\s]+@[^@\s]+\.[^@\s]+$'
+
+
+def read_roster(file_storage):
+    """
+    reads an uploaded .xlsx/.csv roster into a DataFrame of strings with normalized column names. raises ValueError
+    (or UnicodeDecodeError) if the file can't be read
+    """
+    # pandas takes a good part of a second to import and only the roster import needs it
+    import pandas as pd
+
+    filename = secure_filename(file_storage.filename)
+    if filename.lower().endswith('.csv'):
+        roster = pd.read_csv(file_storage.stream, dtype=str, keep_default_na=False)
+    else:
+        from openpyxl.utils.exceptions import InvalidFileException
+        try:
+            roster = pd.read_excel(file_storage.stream, dtype=str, keep_default_na=False, engine='openpyxl')
+        except (zipfile.BadZipFile, InvalidFileException) as error:
+            # a corrupt or renamed file, reported like any other file that can't be read
+            raise ValueError(f"it isn't a valid .xlsx file: {error}") from error
+    roster.columns = [str(col).strip().lower().replace(' ', '_') for col in roster.columns]
+    return roster
+
+
+def validate_roster(roster):
+    """
+    validates a whole roster column by column.
+
+    returns the DataFrame of valid rows (with a parsed date column) and a list of (row number, error) for the rest,
+    where the row number is the line in the uploaded file
+    """
+    import pandas as pd
+
+    missing_columns = [col for col in IMPORT_REQUIRED_COLUMNS if col not in roster.columns]
+    if missing_columns:
+        return roster.iloc[0:0], [(1, f"Missing column(s): {', '.join(missing_columns)}")]
+    if 'comments' not in roster.columns:
+        roster['comments'] = ''
+
+    roster = roster.apply(lambda col: col.astype(str).str.strip())
+    parsed_dates = pd.to_datetime(roster['date'], errors='coerce')
+    errors = pd.Series('', index=roster.index)
+    for col in IMPORT_REQUIRED_COLUMNS:
+        errors = errors.where(roster[col] != '', errors + f"{col} is required; ")
+    errors = errors.where(roster['role'].isin(ROLE_CHOICES) | (roster['role'] == ''),
+                          errors + f"role must be one of {', '.join(ROLE_CHOICES)}; ")
+    errors = errors.where(parsed_dates.notna() | (roster['date'] == ''), errors + "date isn't a valid date; ")
+    errors = errors.where(parsed_dates.isna() | (parsed_dates.dt.date >= date.today()),
+                          errors + "date is in the past; ")
+    errors = errors.where(roster['contact_email'].str.match(EMAIL_PATTERN) | (roster['contact_email'] == ''),
+                          errors + "contact_email isn't a valid email; ")
+
+    is_valid = errors == ''
+    valid_rows = roster[is_valid].assign(date=parsed_dates[is_valid].dt.date)
+    row_errors = [(row_number + 2, message.rstrip('; ')) for row_number, message in errors[~is_valid].items()]
+    return valid_rows, row_errors
+
+
+SHIFT_HISTORY_EXPORT_COLUMNS = [
+    ('Shift ID', Shifts.shift_id), ('Picked up by', Shifts.picked_up_by), ('Role', Shifts.role),
+    ('Hospital Area', Shifts.area), ('Date', Shifts.date), ('Start Time', Shifts.start_time),
+    ('End Time', Shifts.end_time), ('Shift Contact', Shifts.contact_name), ('Contact Email', Shifts.contact_email),
+    ('Posted', Shifts.create_dt_tm), ('Approved', Shifts.approved_dt_tm)
+]
+
+REQUEST_EXPORT_COLUMNS = [
+    ('Request ID', Requests.transaction_id), ('Shift ID', Requests.shift_id), ('Shift Date', Shifts.date),
+    ('Hospital Area', Shifts.area), ('Role', Shifts.role), ('Status', Requests.status),
+    ('Requested by', Requests.requested_by_name), ('Requester Email', Requests.requested_by_email),
+    ('Requester Phone', Requests.requested_by_phone), ('Comments', Requests.comments),
+    ('Requested', Requests.create_dt_tm), ('Approved', Requests.approved_dt_tm)
+]
+
+
+def parse_exclusions(text):
+    """
+    the set of dates in a comma separated YYYY-MM-DD list. raises ValueError for anything else
+    """
+    return {datetime.strptime(part.strip(), '%Y-%m-%d').date() for part in (text or '').split(',') if part.strip()}
+
+
+def series_dates(series):
+    """
+    every date the series has a shift on: the chosen weekdays of every interval_weeks-th week (counting from the week
+    of start_date) between start_date and end_date, minus the exclusions
+    """
+    weekdays = {int(day) for day in series.weekdays.split(',')}
+    exclusions = parse_exclusions(series.exclusions)
+    first_week = series.start_date - timedelta(days=series.start_date.weekday())
+    cur_date = series.start_date
+    while cur_date <= series.end_date:
+        week_number = (cur_date - first_week).days // 7
+        if cur_date.weekday() in weekdays and week_number % series.interval_weeks == 0 \
+                and cur_date not in exclusions:
+            yield cur_date
+        cur_date += timedelta(days=1)
+
+
+def series_shift_values(series):
+    """
+    the column values every shift generated from the series shares
+    """
+    return dict(
+        area=series.area,
+        role=series.role,
+        start_time=series.start_time,
+        end_time=series.end_time,
+        comments=series.comments,
+        contact_name=series.contact_name,
+        contact_email=series.contact_email
+    )
+
+
+def future_series_shifts(series):
+    """
+    the series' shifts from today on that haven't been filled or removed
+    """
+    return db.session.query(Shifts) \
+        .filter(Shifts.series_id == series.series_id, Shifts.date >= date.today(),
+                Shifts.status.in_(OPEN_SHIFT_STATUSES))
+
+
+def sync_series_shifts(series, times_changed=True):
+    """
+    brings the series' future shifts in line with the series: open shifts on dates that dropped out are removed, the
+    rest get the series' details, and dates that don't have a shift yet get one (all inserted in one bulk insert).
+    shifts that were already filled or removed are left alone
+    """
+    wanted_dates = {series_date for series_date in series_dates(series) if series_date >= date.today()}
+    if wanted_dates:
+        future_series_shifts(series).filter(Shifts.date.notin_(wanted_dates)) \
+            .update({Shifts.status: 'Removed', Shifts.closed_dt_tm: datetime.now()}, synchronize_session=False)
+    else:
+        future_series_shifts(series).update({Shifts.status: 'Removed', Shifts.closed_dt_tm: datetime.now()},
+                                            synchronize_session=False)
+
+    future_series_shifts(series).update(series_shift_values(series), synchronize_session=False)
+    if times_changed:
+        # the timestamps depend on each shift's date, so they go out as one executemany
+        timestamps = [dict(shift_id=shift_id, **shift_times(shift_date, series.start_time, series.end_time))
+                      for shift_id, shift_date in future_series_shifts(series)
+                      .with_entities(Shifts.shift_id, Shifts.date)]
+        db.session.bulk_update_mappings(Shifts, timestamps)
+
+    existing_dates = {shift_date for (shift_date,) in db.session.query(Shifts.date)
+                      .filter(Shifts.series_id == series.series_id, Shifts.date >= date.today())}
+    cur_dt = datetime.now().replace(microsecond=0)
+    new_shifts = [
+        dict(
+            hospital_id=series.hospital_id,
+            series_id=series.series_id,
+            date=series_date,
+            status='Posted',
+            create_dt_tm=cur_dt,
+            **series_shift_values(series),
+            **shift_times(series_date, series.start_time, series.end_time)
+        )
+        for series_date in sorted(wanted_dates - existing_dates)
+    ]
+    if new_shifts:
+        db.session.bulk_insert_mappings(Shifts, new_shifts)
+    bump_board_version(series.hospital_id)
+    publish_shift_event(series.hospital_id, 'board-changed')
+    return len(new_shifts)
+
+
+def export_date_range():
+    """
+    the optional start/end (YYYY-MM-DD) dates of an export request. a bad date is a 400
+    """
+    try:
+        start = request.args.get('start')
+        end = request.args.get('end')
+        start = datetime.strptime(start, '%Y-%m-%d').date() if start else None
+        end = datetime.strptime(end, '%Y-%m-%d').date() if end else None
+    except ValueError:
+        abort(400)
+    return start, end
+
 
-# allow app to use Session functionality
-Session(app)
+# a cell starting with one of these is run as a formula when the export is opened in a spreadsheet
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
 
-# allow app to use Bootstrap formatting
-Bootstrap(app)
 
-# allow app to have default current user characteristics such as is_authenticated status
-login_manager = LoginManager()
-login_manager.init_app(app)
+def spreadsheet_safe(row):
+    """
+    the row's values with any text that would be taken as a formula (e.g. a requester typing =HYPERLINK(...) as their
+    name) escaped with a leading ' so it's shown as typed
+    """
+    return [f"'{value}" if isinstance(value, str) and value.startswith(FORMULA_PREFIXES) else value for value in row]
 
 
-@login_manager.user_loader
-def load_user(user_id):
+def export_response(query, export_columns, filename):
     """
-    load the info for the current user
+    exports the query as CSV or XLSX (the format query arg).
+
+    rows are read in chunks with yield_per (a server-side cursor on Postgres). CSV is streamed to the client as it's
+    read; XLSX goes through a write-only workbook saved to a temp file, so neither keeps the whole export in memory
     """
-    return Hospital.query.get(int(user_id))
+    headers = [header for header, column in export_columns]
+    rows = query.with_entities(*[column for header, column in export_columns]) \
+        .yield_per(app.config['EXPORT_CHUNK_SIZE'])
+
+    if request.args.get('format') == 'xlsx':
+        # openpyxl is slow to import, so it's only loaded once someone exports a spreadsheet
+        from openpyxl import Workbook
+
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        sheet.append(headers)
+        for row in rows:
+            sheet.append(spreadsheet_safe(row))
+        export_file = tempfile.TemporaryFile()
+        workbook.save(export_file)
+        export_file.seek(0)
+        return send_file(export_file, as_attachment=True, attachment_filename=f'{filename}.xlsx',
+                         mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(headers)
+        for row_number, row in enumerate(rows, start=1):
+            writer.writerow(spreadsheet_safe(row))
+            if row_number % app.config['EXPORT_CHUNK_SIZE'] == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    return Response(stream_with_context(generate()), mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename={filename}.csv'})
+
+
+def approve_shift_request(hospital_id, shift_id, request_id, cur_dt):
+    """
+    fills the shift with the request and passes over the shift's other requests. the caller bumps the board version,
+    publishes the event and commits.
+
+    the shift is only filled if it's still open, so when two admins approve at once only the first one wins. returns
+    whether it was filled (if it wasn't nothing has been changed)
+    """
+    request_to_approve = db.session.query(Requests) \
+        .filter(Requests.transaction_id == request_id, Requests.shift_id == shift_id)
+    requested_by_email = request_to_approve.with_entities(Requests.requested_by_email).as_scalar()
+
+    shift_updated = db.session.query(Shifts) \
+        .filter(Shifts.shift_id == shift_id, Shifts.hospital_id == hospital_id,
+                Shifts.status.in_(OPEN_SHIFT_STATUSES), request_to_approve.exists()) \
+        .update({Shifts.status: 'Approved', Shifts.approved_dt_tm: cur_dt, Shifts.picked_up_by: requested_by_email,
+                 Shifts.closed_dt_tm: datetime.now()}, synchronize_session=False)
+    if not shift_updated:
+        return False
+
+    request_to_approve.update({Requests.status: 'Approved', Requests.approved_dt_tm: cur_dt},
+                              synchronize_session=False)
+    db.session.query(Requests) \
+        .filter(Requests.shift_id == shift_id, Requests.transaction_id != request_id) \
+        .update({Requests.status: 'Passed'}, synchronize_session=False)
+    return True
+
+
+def queue_approval_emails(shift, app_request):
+    """
+    queues the emails for an approved request: the good news for the requester (and the shift's contact), and a note
+    for everyone who was passed over. the caller commits
+    """
+    shift_email = shift.contact_email
+    shift_name = shift.contact_name
+    request_email = app_request.requested_by_email
+    request_name = app_request.requested_by_name
 
+    contents = f"{request_name} - great news, your request for the {shift.date} shift in the {shift.area} area " \
+               f"was approved!\n" \
+               f"Please reach out to {shift_name} ({shift_email}) with any questions you might have.\n" \
+               "From,\nYour trusty pals at Shift Helper"
 
-# allow SQLAlchemy to be incorporated from a db perspective
-db = SQLAlchemy(app)
+    queue_email([request_email, shift_email], f"Your request for the {shift.date} shift has been approved!", contents)
 
+    pass_emails = db.session.query(Requests.requested_by_email).distinct() \
+        .filter(Requests.shift_id == shift.shift_id, Requests.status == 'Passed')
 
-# user class and db table
-class Hospital(UserMixin, db.Model):
+    contents = f"Thank you for submitting a request for the {shift.date} shift in the {shift.area} area.\n" \
+               "Unfortunately this shift was given to someone else. Thanks again for your interest in this shift and " \
+               "please do continue to requesting more shifts. We need all the help we can get\n" \
+               "From, Your trusty pals at Shift Helper"
+
+    # one email each, so the requesters who were passed over don't see each other's addresses
+    subject = f"Sorry, request for the {shift.date} shift was approved for someone else"
+    for pass_email, in pass_emails:
+        queue_email(pass_email, subject, contents)
+    queue_email(email_address, subject, contents)
+
+
+def api_error(status, message):
     """
-    The class (and db table) for the hospital data. Each entry will be a new "user" of the app.
+    ends a JSON API request with an error response
+    """
+    response = jsonify(error=message)
+    response.status_code = status
+    abort(response)
 
-    This info ix mixed in as the user info so we can maintain info of the user that's currently logged in
+
+def api_token_hash(token):
     """
-    id = db.Column(db.Integer, primary_key=True)
-    hospital_name = db.Column(db.String(1000))
-    admin_name = db.Column(db.String(1000))
-    admin_email = db.Column(db.String(100))
-    admin_password = db.Column(db.String(1000))
-    staff_password = db.Column(db.String(1000))
-    created_date = db.Column(db.TIMESTAMP)
+    what's stored for an API token. the tokens are long and random, so a plain SHA-256 is enough to look them up by
+    """
+    return hashlib.sha256(token.encode()).hexdigest()
 
 
-class Shifts(db.Model):
+def api_token_required(view):
     """
-    The class (and db table) for the shift data. Each entry will be a distinct shift in the system
+    decorator for the JSON API views. instead of a login they take an "Authorization: Bearer <token>" header (see
+    create-api-token), and everything they do is scoped to g.api_hospital_id, the hospital the token belongs to
     """
-    shift_id = db.Column(db.Integer, primary_key=True)
-    hospital_id = db.Column(db.Integer)
-    area = db.Column(db.String)
-    role = db.Column(db.String)
-    date = db.Column(db.Date)
-    start_time = db.Column(db.String)
-    end_time = db.Column(db.String)
-    comments = db.Column(db.String)
-    status = db.Column(db.String)
-    picked_up_by = db.Column(db.String)
-    approved_dt_tm = db.Column(db.TIMESTAMP)
-    create_dt_tm = db.Column(db.TIMESTAMP)
-    contact_name = db.Column(db.String)
-    contact_email = db.Column(db.String)
+    @functools.wraps(view)
+    def check_api_token(*args, **kwargs):
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        if scheme.lower() != 'bearer' or not token.strip():
+            api_error(401, 'an "Authorization: Bearer <token>" header is required')
+        api_token = ApiToken.query \
+            .filter(ApiToken.token_hash == api_token_hash(token.strip()), ApiToken.revoked_dt_tm.is_(None)).first()
+        if api_token is None:
+            api_error(401, 'the API token is invalid or has been revoked')
+
+        cur_dt = datetime.now()
+        touch_after = timedelta(seconds=app.config['API_TOKEN_TOUCH_SECONDS'])
+        if api_token.last_used_dt_tm is None or cur_dt - api_token.last_used_dt_tm > touch_after:
+            api_token.last_used_dt_tm = cur_dt
+            db.session.commit()
+        g.api_hospital_id = api_token.hospital_id
+        return view(*args, **kwargs)
+    return check_api_token
+
+
+@app.cli.command('create-api-token')
+@click.argument('hospital_id', type=int)
+@click.option('--name', default='', help='what the token is for, e.g. the scheduling system that will use it')
+def create_api_token_command(hospital_id, name):
+    """
+    creates a JSON API token for a hospital and prints it. only its hash is kept, so it can't be shown again
+    """
+    if Hospital.query.get(hospital_id) is None:
+        raise click.ClickException(f'there is no hospital {hospital_id}')
+    token = secrets.token_urlsafe(32)
+    api_token = ApiToken(hospital_id=hospital_id, name=name, token_hash=api_token_hash(token),
+                         create_dt_tm=datetime.now())
+    db.session.add(api_token)
+    db.session.commit()
+    print(f'token {api_token.token_id} for hospital {hospital_id}: {token}')
+
+
+@app.cli.command('revoke-api-token')
+@click.argument('token_id', type=int)
+def revoke_api_token_command(token_id):
+    """
+    stops an API token from working
+    """
+    revoked = ApiToken.query.filter(ApiToken.token_id == token_id, ApiToken.revoked_dt_tm.is_(None)) \
+        .update({ApiToken.revoked_dt_tm: datetime.now()}, synchronize_session=False)
+    db.session.commit()
+    print(f'revoked token {token_id}' if revoked else f'there is no active token {token_id}')
 
 
-class Requests(db.Model):
+def api_id(value):
     """
-    The class (and db table) for the request data. Each entry will be a distinct request in the system
+    value if it's an integer id from a JSON body, otherwise None
     """
-    transaction_id = db.Column(db.Integer, primary_key=True)
-    shift_id = db.Column(db.Integer)
-    hospital_id = db.Column(db.Integer)
-    status = db.Column(db.String)
-    create_dt_tm = db.Column(db.TIMESTAMP)
-    approved_dt_tm = db.Column(db.TIMESTAMP)
-    requested_by_name = db.Column(db.String)
-    requested_by_email = db.Column(db.String)
-    requested_by_phone = db.Column(db.String)
-    comments = db.Column(db.String)
+    return value if isinstance(value, int) and not isinstance(value, bool) else None
 
 
-# class to have a user sign up their location
-class SignupForm(FlaskForm):
+def api_timestamp(value):
     """
-    structure of the signup form of a FlaskForm object
+    a timestamp as the JSON API sends it (ISO 8601), or None
     """
-    admin_name = StringField(label='Name', validators=[DataRequired()])
-    admin_email = EmailField(label='Email', validators=[DataRequired(), Email()])
-    hospital_name = StringField(label='Hospital Name', validators=[DataRequired()])
-    admin_password = StringField(label='Admin Login', validators=[Length(min=4)])
-    staff_password = StringField(label='Staff Login', validators=[Length(min=4)])
-    submit = SubmitField(label='Sign up')
+    return value.isoformat() if value else None
 
 
-# class to indicate the fields that'll be used on the app's Add Shift form
-class ShiftForm(FlaskForm):
+def api_shift_to_dict(shift):
     """
-    structure of the add shift form of a FlaskForm object
+    the JSON API form of a shift
     """
-    area = StringField(label='Area (e.g. ICU)', validators=[DataRequired()])
-    role = SelectField(label='Role', choices=["RN", "CRNA", "Medical Assistant", "Scrub Tech"]
-                       , validators=[DataRequired()])
-    date = DateField(label='Shift Date', format='%Y-%m-%d', validators=[DataRequired()])
-    start_time = StringField(label='Start Time (e.g. 8am)', validators=[DataRequired()])
-    end_time = StringField(label='End Time (e.g. 5pm)', validators=[DataRequired()])
-    contact_name = StringField(label="Contact's name", validators=[DataRequired()])
-    contact_email = EmailField(label="Contact's email", validators=[DataRequired(), Email()])
-    comments = StringField(label='Comments (competencies, random notes, etc.)')
-    submit = SubmitField(label="Add Open Shift")
+    return {
+        'shift_id': shift.shift_id,
+        'status': shift.status,
+        'area': shift.area,
+        'role': shift.role,
+        'date': str(shift.date.date() if isinstance(shift.date, datetime) else shift.date),
+        'start_time': shift.start_time,
+        'end_time': shift.end_time,
+        'start_dt_tm': api_timestamp(shift.start_dt_tm),
+        'end_dt_tm': api_timestamp(shift.end_dt_tm),
+        'comments': shift.comments,
+        'contact_name': shift.contact_name,
+        'contact_email': shift.contact_email,
+        'request_count': shift.request_count or 0,
+        'last_request_dt_tm': api_timestamp(shift.last_request_dt_tm),
+        'picked_up_by': shift.picked_up_by,
+        'series_id': shift.series_id,
+        'create_dt_tm': api_timestamp(shift.create_dt_tm),
+        'approved_dt_tm': api_timestamp(shift.approved_dt_tm),
+        'closed_dt_tm': api_timestamp(shift.closed_dt_tm)
+    }
+
+
+def api_request_to_dict(app_request):
+    """
+    the JSON API form of a request
+    """
+    return {
+        'request_id': app_request.transaction_id,
+        'shift_id': app_request.shift_id,
+        'status': app_request.status,
+        'requested_by_name': app_request.requested_by_name,
+        'requested_by_email': app_request.requested_by_email,
+        'requested_by_phone': app_request.requested_by_phone,
+        'comments': app_request.comments,
+        'create_dt_tm': api_timestamp(app_request.create_dt_tm),
+        'approved_dt_tm': api_timestamp(app_request.approved_dt_tm)
+    }
+
+
+def api_date_arg(name):
+    """
+    the YYYY-MM-DD date in the named query string argument, or None if it wasn't given
+    """
+    if not request.args.get(name):
+        return None
+    try:
+        return date.fromisoformat(request.args[name])
+    except ValueError:
+        api_error(400, f'{name} must be a YYYY-MM-DD date')
 
 
-class RequestForm(FlaskForm):
+def api_page(query, id_column):
     """
-    structure of the request shift form of a FlaskForm object
+    one page of a JSON API listing, in id order, after the page the cursor argument points at.
+
+    the cursor is opaque to clients but only carries the last id they've been sent, so paging isn't thrown off by rows
+    being added meanwhile and every page is an index range scan. the cursor after the last page picks up only rows
+    added since, so a client can keep it for its next sync. returns the rows, the next cursor and whether there are
+    more rows already
     """
-    requestor_name = StringField(label="What's your name?", validators=[DataRequired()])
-    label_for_email = Markup(
-        "What's your email? <span class='email-italic'>(will be used to provide updates on shift)</span>")
-    requestor_email = EmailField(label_for_email
-                                 , validators=[DataRequired(), Email()])
-    requestor_phone_num = StringField(label="What's your phone number?")
-    requestor_comments = StringField(label="Any comments you'd like to share?")
-    submit = SubmitField(label="Request Open Shift")
+    after = 0
+    if request.args.get('cursor'):
+        try:
+            after = int(base64.urlsafe_b64decode(request.args['cursor'].encode()).decode())
+        except ValueError:
+            api_error(400, 'cursor is not valid')
+    limit = request.args.get('limit', app.config['MAX_PAGE_SIZE'], type=int)
+    if limit < 1 or limit > app.config['MAX_PAGE_SIZE']:
+        limit = app.config['MAX_PAGE_SIZE']
+
+    rows = query.filter(id_column > after).order_by(id_column).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if rows:
+        after = getattr(rows[-1], id_column.key)
+    return rows, base64.urlsafe_b64encode(str(after).encode()).decode(), has_more
+
+
+API_SHIFT_FIELDS = IMPORT_REQUIRED_COLUMNS + ['comments']
+
 
+def api_shift_values(item, required):
+    """
+    checks the fields of a shift sent to the JSON API the way rows of an imported roster are checked (see
+    validate_roster). with required every field but comments has to be there, otherwise only the fields sent are
+    checked.
 
-# create the databases with the above tables
-db.create_all()
+    returns the values to set and a list of problems
+    """
+    values, errors = {}, []
+    unknown_fields = set(item) - set(API_SHIFT_FIELDS) - {'shift_id', 'ref'}
+    if unknown_fields:
+        errors.append(f"unknown fields {', '.join(sorted(unknown_fields))}")
+    for field in API_SHIFT_FIELDS:
+        value = item.get(field)
+        if field == 'comments' and value is None:
+            value = '' if required or field in item else None
+        if value is None:
+            if required or field in item:
+                errors.append(f"{field} is required")
+            continue
+        if not isinstance(value, str):
+            errors.append(f"{field} must be a string")
+            continue
+        values[field] = value.strip()
+        if not values[field] and field != 'comments':
+            errors.append(f"{field} is required")
+
+    if values.get('role') and values['role'] not in ROLE_CHOICES:
+        errors.append(f"role must be one of {', '.join(ROLE_CHOICES)}")
+    if values.get('date'):
+        try:
+            values['date'] = date.fromisoformat(values['date'])
+        except ValueError:
+            errors.append("date isn't a valid date")
+        else:
+            if values['date'] < date.today():
+                errors.append("date is in the past")
+    if values.get('contact_email') and not re.match(EMAIL_PATTERN, values['contact_email']):
+        errors.append("contact_email isn't a valid email")
+    return values, errors
 
 
 @app.route('/')
@@ -176,16 +2676,17 @@ def home():
 
 
 @app.route('/about')
+@read_replica
 def about():
     """
     take user to the about page
     """
     if current_user.is_authenticated:
-        cur_hospital = Hospital.query.get(current_user.id)
+        cur_hospital = get_hospital(current_user.id)
         return render_template('about.html', hospital=cur_hospital, logged_in=True)
     elif session.get('hospital_id'):
         hospital_id = session.get('hospital_id')
-        cur_hospital = Hospital.query.get(hospital_id)
+        cur_hospital = get_hospital(hospital_id)
         return render_template('about.html', hospital=cur_hospital, logged_in=True)
     else:
         return render_template('about.html', hospital_id=0)
@@ -198,15 +2699,12 @@ def login():
     """
     if request.method == 'POST':
         password = request.form['password']
-        hospitals = db.session.query(Hospital).all()
-        for hospital in hospitals:
-            if check_password_hash(hospital.admin_password, password):
-                login_user(hospital)
-                return redirect(url_for('pending_shifts', hospital_id=current_user.id))
-
-        for hospital in hospitals:
-            if check_password_hash(hospital.staff_password, password):
-                return redirect(url_for('shifts', hospital_id=hospital.id))
+        hospital, login_type = match_login(password, ('admin', 'staff'))
+        if login_type == 'admin':
+            login_user(hospital)
+            return redirect(url_for('pending_shifts', hospital_id=current_user.id))
+        if login_type == 'staff':
+            return redirect(url_for('shifts', hospital_id=hospital.id))
 
         flash("Login does not exist. Please try again or contact your site's administrator")
         return redirect(url_for('login'))
@@ -231,18 +2729,15 @@ def signup():
             method='pbkdf2:sha256',
             salt_length=8
         )
-        hospitals = db.session.query(Hospital).all()
         if signup_form.staff_password.data == signup_form.admin_password.data:
             flash('Admin and Staff logins cannot match. Please choose separate logins.')
             return redirect(url_for('signup'))
-        for hospital in hospitals:
-            if check_password_hash(hospital.admin_password, signup_form.admin_password.data):
-                flash('This admin password has already been taken. Please choose another one.')
-                return redirect(url_for('signup'))
-        for hospital in hospitals:
-            if check_password_hash(hospital.staff_password, signup_form.staff_password.data):
-                flash('This staff password has already been taken. Please choose another one.')
-                return redirect(url_for('signup'))
+        if match_login(signup_form.admin_password.data, ('admin',))[0]:
+            flash('This admin password has already been taken. Please choose another one.')
+            return redirect(url_for('signup'))
+        if match_login(signup_form.staff_password.data, ('staff',))[0]:
+            flash('This staff password has already been taken. Please choose another one.')
+            return redirect(url_for('signup'))
 
         cur_dt = datetime.now().strftime("%Y-%m-%d %H:%M")
         cur_dt = datetime.strptime(cur_dt, "%Y-%m-%d %H:%M")
@@ -253,10 +2748,13 @@ def signup():
             admin_email=signup_form.admin_email.data,
             admin_password=hashed_admin_password,
             staff_password=hashed_staff_password,
+            admin_password_fingerprint=credential_fingerprint(signup_form.admin_password.data),
+            staff_password_fingerprint=credential_fingerprint(signup_form.staff_password.data),
             created_date=cur_dt
         )
         db.session.add(new_hospital)
         db.session.commit()
+        hospital_cache.invalidate(new_hospital.id)
         login_user(new_hospital)
 
         session['admin_password'] = signup_form.admin_password.data
@@ -274,7 +2772,7 @@ def signup_success():
     so they can keep for their personal records
     """
     hospital_id = request.args['hospital_id']
-    hospital = Hospital.query.get(hospital_id)
+    hospital = get_hospital(hospital_id)
 
     contents = f"Thank you so much for signing up for Shift Helper! Below you will find your registration info so " \
                f"you're able to retrieve as needed.\n\n" \
@@ -285,14 +2783,8 @@ def signup_success():
                f"Staff Login: {session['staff_password']}\n\n" \
                "From,\nYour trusty pals at Shift Helper"
 
-    with smtplib.SMTP("smtp.office365.com", 587) as connection:
-        connection.starttls()
-        connection.login(email_address, email_password)
-        connection.sendmail(
-            from_addr=email_address,
-            to_addrs=hospital.admin_email,
-            msg=f"Subject: Shift Helper Signup Info!\n\n{contents}"
-        )
+    queue_email(hospital.admin_email, "Shift Helper Signup Info!", contents)
+    db.session.commit()
     return render_template('signup_success.html', hospital=hospital, logged_in=True)
 
 
@@ -304,7 +2796,7 @@ def add_shifts():
     """
     shift_form = ShiftForm()
     shift_form.validate_on_submit()
-    cur_hospital = Hospital.query.get(current_user.id)
+    cur_hospital = get_hospital(current_user.id)
     if request.method == 'POST':
         cur_dt = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         cur_dt = datetime.strptime(cur_dt, "%Y-%m-%d %H:%M:%S")
@@ -319,10 +2811,14 @@ def add_shifts():
             status='Posted',
             create_dt_tm=cur_dt,
             contact_name=shift_form.contact_name.data,
-            contact_email=shift_form.contact_email.data
+            contact_email=shift_form.contact_email.data,
+            **shift_times(shift_form.date.data, shift_form.start_time.data, shift_form.end_time.data)
         )
 
         db.session.add(new_shift)
+        db.session.flush()
+        bump_board_version(current_user.id)
+        publish_shift_event(current_user.id, 'shift-posted', new_shift.shift_id, shift_event_payload(new_shift))
         db.session.commit()
 
         return redirect(url_for('shifts', hospital_id=current_user.id))
@@ -330,21 +2826,337 @@ def add_shifts():
     return render_template('add_shifts.html', hospital=cur_hospital, logged_in=True, form=shift_form)
 
 
+@app.route('/import_shifts', methods=['GET', 'POST'])
+@login_required
+def import_shifts():
+    """
+    allows the user to add many shifts at once from an uploaded roster. valid rows are added in one transaction and
+    the rows with problems are listed back to the user
+    """
+    import_form = ImportShiftsForm()
+    cur_hospital = get_hospital(current_user.id)
+    if import_form.validate_on_submit():
+        try:
+            roster = read_roster(import_form.roster.data)
+        except (ValueError, UnicodeDecodeError) as error:
+            flash(f"We couldn't read that file ({error}). Please check it and try again.")
+            return redirect(url_for('import_shifts'))
+
+        valid_rows, row_errors = validate_roster(roster)
+        cur_dt = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        cur_dt = datetime.strptime(cur_dt, "%Y-%m-%d %H:%M:%S")
+        new_shifts = [
+            dict(
+                hospital_id=current_user.id,
+                area=row.area,
+                role=row.role,
+                date=row.date,
+                start_time=row.start_time,
+                end_time=row.end_time,
+                comments=row.comments,
+                status='Posted',
+                create_dt_tm=cur_dt,
+                contact_name=row.contact_name,
+                contact_email=row.contact_email,
+                **shift_times(row.date, row.start_time, row.end_time)
+            )
+            for row in valid_rows.itertuples(index=False)
+        ]
+        if new_shifts:
+            db.session.bulk_insert_mappings(Shifts, new_shifts)
+            bump_board_version(current_user.id)
+            publish_shift_event(current_user.id, 'board-changed')
+            db.session.commit()
+
+        return render_template('import_shifts.html', hospital=cur_hospital, logged_in=True, form=import_form,
+                               imported=len(new_shifts), row_errors=row_errors)
+
+    return render_template('import_shifts.html', hospital=cur_hospital, logged_in=True, form=import_form)
+
+
+@app.route('/series', methods=['GET'])
+@login_required
+def shift_series():
+    """
+    lists the hospital's recurring shifts
+    """
+    cur_hospital = get_hospital(current_user.id)
+    series_list = ShiftSeries.query \
+        .filter(ShiftSeries.hospital_id == current_user.id, ShiftSeries.status == 'Active') \
+        .order_by(ShiftSeries.area, ShiftSeries.role, ShiftSeries.start_date)
+    return render_template('series.html', series_list=series_list, weekday_names=dict(WEEKDAY_CHOICES),
+                           hospital=cur_hospital, logged_in=True)
+
+
+@app.route('/add_series', methods=['GET', 'POST'])
+@login_required
+def add_series():
+    """
+    allows the user to post a recurring shift, which adds all of its occurrences at once
+    """
+    series_form = ShiftSeriesForm()
+    cur_hospital = get_hospital(current_user.id)
+    if series_form.validate_on_submit():
+        new_series = ShiftSeries(hospital_id=current_user.id, status='Active', create_dt_tm=datetime.now())
+        series_form.populate_obj(new_series)
+        new_series.weekdays = ",".join(series_form.weekdays.data)
+        db.session.add(new_series)
+        db.session.flush()
+        added = sync_series_shifts(new_series)
+        db.session.commit()
+        flash(f'{added} shift(s) were added.')
+        return redirect(url_for('shift_series'))
+
+    return render_template('series_form.html', hospital=cur_hospital, logged_in=True, form=series_form,
+                           title='Add Recurring Shift')
+
+
+@app.route('/edit_series', methods=['GET', 'POST'])
+@login_required
+def edit_series():
+    """
+    allows admins to edit a recurring shift. all of its future open shifts are updated to match
+    """
+    cur_hospital = get_hospital(current_user.id)
+    series = ShiftSeries.query \
+        .filter(ShiftSeries.series_id == request.args.get('id'), ShiftSeries.hospital_id == current_user.id) \
+        .first_or_404()
+    series_form = ShiftSeriesForm(obj=series)
+    if request.method == 'GET':
+        series_form.weekdays.data = series.weekdays.split(',')
+    if series_form.validate_on_submit():
+        old_times = (series.start_time, series.end_time)
+        series_form.populate_obj(series)
+        series.weekdays = ",".join(series_form.weekdays.data)
+        added = sync_series_shifts(series, times_changed=old_times != (series.start_time, series.end_time))
+        db.session.commit()
+        flash(f'The recurring shift was updated ({added} new shift(s) added).')
+        return redirect(url_for('shift_series'))
+
+    return render_template('series_form.html', hospital=cur_hospital, logged_in=True, form=series_form,
+                           title='Edit Recurring Shift')
+
+
+@app.route('/cancel_series', methods=['POST'])
+@login_required
+def cancel_series():
+    """
+    allows admins to cancel a recurring shift, removing all of its future open shifts
+    """
+    series = ShiftSeries.query \
+        .filter(ShiftSeries.series_id == request.form['id'], ShiftSeries.hospital_id == current_user.id) \
+        .first_or_404()
+    series.status = 'Cancelled'
+    removed = future_series_shifts(series).update({Shifts.status: 'Removed', Shifts.closed_dt_tm: datetime.now()},
+                                                  synchronize_session=False)
+    bump_board_version(series.hospital_id)
+    publish_shift_event(series.hospital_id, 'board-changed')
+    db.session.commit()
+    flash(f'The recurring shift was cancelled ({removed} shift(s) removed).')
+    return redirect(url_for('shift_series'))
+
+
 @app.route('/shifts', methods=['GET'])
+@read_replica
 def shifts():
     """
     displays all available shifts
     """
     hospital_id = request.args['hospital_id']
-    session['hospital_id'] = hospital_id
-    cur_hospital = Hospital.query.get(hospital_id)
-    cur_date = date.today()
-    available_shifts = db.session.query(Shifts) \
-        .filter(Shifts.status != 'Approved', Shifts.status != 'Removed', Shifts.date >= cur_date
-                , Shifts.hospital_id == hospital_id) \
-        .order_by(Shifts.date, Shifts.start_time, Shifts.area, Shifts.role)
+    if session.get('hospital_id') != hospital_id:
+        session['hospital_id'] = hospital_id
+    cur_hospital = get_hospital(hospital_id)
+
+    return board_response(hospital_id,
+                          lambda: render_template('shifts.html', hospital=cur_hospital, logged_in=True))
+
+
+@app.route('/shifts/data', methods=['GET'])
+@read_replica
+def shifts_data():
+    """
+    one page of the available shifts table (DataTables server-side processing)
+    """
+    hospital_id = request.args['hospital_id']
+    columns = [Shifts.area, Shifts.role, Shifts.date, Shifts.start_dt_tm, Shifts.end_dt_tm, Shifts.create_dt_tm,
+               Shifts.comments, Shifts.contact_name, None]
+    search_columns = [Shifts.area, Shifts.role, Shifts.comments, Shifts.contact_name, Shifts.start_time,
+                      Shifts.end_time]
+    default_order = [Shifts.date, Shifts.start_dt_tm, Shifts.start_time, Shifts.area, Shifts.role, Shifts.shift_id]
+
+    return board_response(
+        hospital_id,
+        lambda: datatables_page(open_shifts_query(hospital_id), columns, search_columns, default_order,
+                                open_shift_to_dict),
+        datatables_response
+    )
+
+
+@app.route('/shifts/search', methods=['GET'])
+@read_replica
+def search_shifts():
+    """
+    lets staff find open shifts by area, role and the time window they're available. start and end are
+    YYYY-MM-DDTHH:MM and any shift overlapping the window matches, including overnight shifts.
+
+    q is a free text search over area, role and comments (see full_text_match). with it the best matches come first
+    """
+    try:
+        hospital_id = int(request.args['hospital_id'])
+        window_start = datetime.fromisoformat(request.args['start']) if request.args.get('start') else None
+        window_end = datetime.fromisoformat(request.args['end']) if request.args.get('end') else None
+    except ValueError:
+        abort(400)
+    if window_start and window_end and window_end <= window_start:
+        abort(400)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = request.args.get('limit', app.config['MAX_PAGE_SIZE'], type=int)
+    if limit < 1 or limit > app.config['MAX_PAGE_SIZE']:
+        limit = app.config['MAX_PAGE_SIZE']
+
+    matching_shifts = open_shifts_query(hospital_id)
+    if window_start:
+        # shifts are at most MAX_SHIFT_HOURS long, so bounding the start keeps this an index range scan
+        earliest_start = window_start - timedelta(hours=app.config['MAX_SHIFT_HOURS'])
+        matching_shifts = matching_shifts.filter(Shifts.start_dt_tm >= earliest_start, Shifts.end_dt_tm > window_start)
+    if window_end:
+        matching_shifts = matching_shifts.filter(Shifts.start_dt_tm < window_end)
+    if request.args.get('area'):
+        matching_shifts = matching_shifts.filter(func.lower(Shifts.area) == request.args['area'].strip().lower())
+    if request.args.get('role'):
+        matching_shifts = matching_shifts.filter(Shifts.role == request.args['role'])
+    relevance = None
+    if request.args.get('q'):
+        matching_shifts, relevance = full_text_match(matching_shifts, hospital_id, request.args['q'])
+    if relevance is not None:
+        matching_shifts = matching_shifts.order_by(relevance)
+
+    rows = matching_shifts.order_by(Shifts.start_dt_tm, Shifts.shift_id).offset(offset).limit(limit + 1).all()
+    next_offset = offset + limit if len(rows) > limit else None
+    return jsonify(shifts=[open_shift_to_dict(row) for row in rows[:limit]], next_offset=next_offset)
+
+
+@app.route('/subscribe', methods=['GET', 'POST'])
+def subscribe():
+    """
+    allows anyone to sign up for email digests of newly posted shifts
+    """
+    subscribe_form = SubscribeForm()
+    hospital_id = request.args['hospital_id']
+    cur_hospital = get_hospital(hospital_id)
+    if cur_hospital is None:
+        abort(404)
+    if subscribe_form.validate_on_submit():
+        subscription_key = dict(hospital_id=cur_hospital.id, email=subscribe_form.email.data.strip().lower(),
+                                area=subscribe_form.area.data.strip().lower(), role=subscribe_form.role.data)
+        subscription = Subscription.query.filter_by(**subscription_key).first()
+        if subscription is None:
+            subscription = Subscription(token=secrets.token_urlsafe(32), status='Pending', create_dt_tm=datetime.now(),
+                                        **subscription_key)
+            db.session.add(subscription)
+        elif subscription.status == 'Cancelled':
+            subscription.status = 'Pending'
+        # nothing is sent to an address until its owner confirms, so nobody can be signed up by someone else
+        if subscription.status == 'Pending':
+            confirm_url = url_for('confirm_subscription', token=subscription.token, _external=True)
+            contents = f"Someone (hopefully you) asked for emails about new {cur_hospital.hospital_name} shifts.\n" \
+                       f"Confirm here to start getting them: {confirm_url}\n" \
+                       "If this wasn't you, just ignore this email and you won't hear from us again.\n" \
+                       "From,\nYour trusty pals at Shift Helper"
+            queue_email(subscription.email, "Confirm your new shift alerts", contents)
+        try:
+            db.session.commit()
+        except exc.IntegrityError:
+            # the same subscription was just made in another request, which sent the confirmation
+            db.session.rollback()
+        return render_template('subscribe.html', hospital=cur_hospital, logged_in=True, pending=True)
+
+    return render_template('subscribe.html', form=subscribe_form, hospital=cur_hospital, logged_in=True)
+
+
+@app.route('/subscribe/confirm', methods=['GET'])
+def confirm_subscription():
+    """
+    turns on the new shift digests for the subscription in the confirmation email's link
+    """
+    subscription = Subscription.query.filter(Subscription.token == request.args.get('token')).first_or_404()
+    if subscription.status == 'Pending':
+        subscription.status = 'Active'
+        db.session.commit()
+    return render_template('subscribe.html', hospital=get_hospital(subscription.hospital_id), logged_in=True,
+                           subscribed=subscription.status == 'Active',
+                           unsubscribed=subscription.status == 'Cancelled')
+
+
+@app.route('/unsubscribe', methods=['GET'])
+def unsubscribe():
+    """
+    turns off the new shift digests for the subscription in the email's link
+    """
+    subscription = Subscription.query.filter(Subscription.token == request.args.get('token')).first_or_404()
+    subscription.status = 'Cancelled'
+    db.session.commit()
+    return render_template('subscribe.html', hospital=get_hospital(subscription.hospital_id), logged_in=True,
+                           unsubscribed=True)
 
-    return render_template('shifts.html', hospital=cur_hospital, shifts=available_shifts, logged_in=True)
+
+@app.route('/events', methods=['GET'])
+def shift_events():
+    """
+    live feed (Server-Sent Events) of changes to a hospital's shifts, used by the boards to update in place.
+
+    browsers reconnect on their own after EVENT_STREAM_SECONDS and send Last-Event-ID, so they catch up on anything
+    posted in between. when the process already has EVENT_STREAMS_PER_PROCESS feeds open the browser gets what it
+    missed straight away and is told to come back in EVENT_FALLBACK_POLL_SECONDS, so the feeds can't take up every
+    thread
+    """
+    hospital_id = request.args.get('hospital_id', type=int)
+    if hospital_id is None:
+        abort(400)
+    last_event_id = request.headers.get('Last-Event-ID', request.args.get('last_event_id', type=int), type=int)
+
+    def stream():
+        listener = shift_event_broker.subscribe(hospital_id, app.config['EVENT_STREAMS_PER_PROCESS'])
+        try:
+            if listener is None:
+                yield f"retry: {app.config['EVENT_FALLBACK_POLL_SECONDS'] * 1000}\n\n"
+            else:
+                yield "retry: 2000\n\n"
+            newest_sent = last_event_id or 0
+            if last_event_id is not None:
+                missed_events = db.session.query(ShiftEvent) \
+                    .filter(ShiftEvent.hospital_id == hospital_id, ShiftEvent.event_id > last_event_id) \
+                    .order_by(ShiftEvent.event_id) \
+                    .limit(500) \
+                    .all()
+                for event in missed_events:
+                    newest_sent = event.event_id
+                    yield format_shift_event(event)
+            elif listener is None:
+                # an id with no data isn't shown to the page, but the browser sends it back as Last-Event-ID
+                newest_event_id = db.session.query(func.max(ShiftEvent.event_id)) \
+                    .filter(ShiftEvent.hospital_id == hospital_id).scalar()
+                yield f"id: {newest_event_id or 0}\n\n"
+            db.session.remove()
+            if listener is None:
+                return
+
+            deadline = time.monotonic() + app.config['EVENT_STREAM_SECONDS']
+            while time.monotonic() < deadline:
+                try:
+                    event = listener.get(timeout=min(15, max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                if event.event_id > newest_sent:
+                    newest_sent = event.event_id
+                    yield format_shift_event(event)
+        finally:
+            if listener is not None:
+                shift_event_broker.unsubscribe(hospital_id, listener)
+
+    return Response(stream_with_context(stream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 @app.route('/request_shift', methods=['GET', 'POST'])
@@ -354,12 +3166,24 @@ def request_shift():
     """
     request_form = RequestForm()
     request_form.validate_on_submit()
-    shift_id = request.args.get('id')
-    shift_info = Shifts.query.get(shift_id)
-    cur_hospital = Hospital.query.get(shift_info.hospital_id)
+    shift_id = request.args.get('id', type=int)
+    shift_info = Shifts.query.get(shift_id) if shift_id is not None else None
+    if shift_info is None or shift_info.status not in OPEN_SHIFT_STATUSES:
+        abort(404)
+    cur_hospital = get_hospital(shift_info.hospital_id)
     if request.method == 'POST':
         cur_dt = datetime.now().strftime("%Y-%m-%d %H:%M")
         cur_dt = datetime.strptime(cur_dt, "%Y-%m-%d %H:%M")
+        # only an open shift takes requests, so one approved (or removed) while the form was up isn't reopened
+        shift_updated = db.session.query(Shifts) \
+            .filter(Shifts.shift_id == shift_id, Shifts.status.in_(OPEN_SHIFT_STATUSES)) \
+            .update({Shifts.status: 'Requested', Shifts.request_count: Shifts.request_count + 1,
+                     Shifts.last_request_dt_tm: cur_dt}, synchronize_session=False)
+        if not shift_updated:
+            db.session.rollback()
+            flash('Sorry, this shift was filled or removed before your request went through.')
+            return render_template('request_shift.html', form=request_form, shift=shift_info, hospital=cur_hospital
+                                   , logged_in=True), 409
         new_request = Requests(
             shift_id=shift_id,
             hospital_id=shift_info.hospital_id,
@@ -371,11 +3195,11 @@ def request_shift():
             comments=request_form.requestor_comments.data
         )
         db.session.add(new_request)
-        shift_to_update = Shifts.query.get(shift_id)
-        shift_to_update.status = 'Requested'
+        bump_board_version(shift_info.hospital_id)
+        publish_shift_event(shift_info.hospital_id, 'shift-requested', shift_id)
         db.session.commit()
 
-        return redirect(url_for('staff_request_email', shift=shift_to_update.shift_id,
+        return redirect(url_for('staff_request_email', shift=shift_id,
                                 staff_request_name=new_request.requested_by_name,
                                 staff_request_email=new_request.requested_by_email))
 
@@ -389,18 +3213,15 @@ def pending_shifts():
     """
     allows admin users to see all the pending shifts and the corresponding request info
     """
-    cur_hospital = Hospital.query.get(current_user.id)
+    cur_hospital = get_hospital(current_user.id)
     cur_date = date.today()
     open_shifts = db.session.query(Shifts) \
-        .join(Requests, Requests.shift_id == Shifts.shift_id, isouter=True) \
-        .filter(Shifts.date >= cur_date, Shifts.hospital_id == current_user.id, Shifts.status != 'Approved'
-                , Shifts.status != 'Removed') \
-        .order_by(Shifts.area, Shifts.role, Shifts.date, Shifts.start_time, Shifts.end_time) \
+        .filter(Shifts.date >= cur_date, Shifts.hospital_id == current_user.id,
+                Shifts.status.in_(OPEN_SHIFT_STATUSES)) \
+        .order_by(Shifts.area, Shifts.role, Shifts.date, Shifts.start_dt_tm, Shifts.end_dt_tm, Shifts.start_time) \
         .with_entities(Shifts.area, Shifts.role, Shifts.date, Shifts.start_time, Shifts.end_time, Shifts.shift_id
                        , Shifts.contact_name, Shifts.contact_email
-                       , Shifts.comments.label('shift_comments'), func.count(Requests.shift_id).label('request_count')) \
-        .group_by(Shifts.area, Shifts.role, Shifts.date, Shifts.start_time, Shifts.end_time, Shifts.shift_id
-                  , Shifts.comments, Shifts.contact_name, Shifts.contact_email)
+                       , Shifts.comments.label('shift_comments'), Shifts.request_count, Shifts.last_request_dt_tm)
     return render_template('pending_shifts.html', shifts=open_shifts, hospital=cur_hospital, logged_in=True)
 
 
@@ -412,28 +3233,24 @@ def approve_request():
 
     approving a request will drop all the other requests for that shift
     """
-    cur_hospital = Hospital.query.get(current_user.id)
+    cur_hospital = get_hospital(current_user.id)
     if request.method == "POST":
         cur_dt = datetime.now().strftime("%Y-%m-%d %H:%M")
         cur_dt = datetime.strptime(cur_dt, "%Y-%m-%d %H:%M")
         cur_shift_id = request.form["shift_id"]
         cur_request_id = request.form["request_id"]
-        shift_to_update = Shifts.query.get(cur_shift_id)
-        request_to_approve = Requests.query.get(cur_request_id)
-        shift_to_update.status = 'Approved'
-        shift_to_update.approved_dt_tm = cur_dt
-        shift_to_update.picked_up_by = request_to_approve.requested_by_email
-        request_to_approve.status = 'Approved'
-        db.session.commit()
-        request_to_approve.approved_dt_tm = cur_dt
-
-        requests_to_pass = db.session.query(Requests) \
-            .filter(Requests.shift_id == cur_shift_id, Requests.status != 'Approved')
-        for req in requests_to_pass:
-            req.status = 'Passed'
+        if not approve_shift_request(current_user.id, cur_shift_id, cur_request_id, cur_dt):
+            db.session.rollback()
+            flash('This shift has already been filled or removed, so the request could not be approved.')
+            request_to_approve = Requests.query \
+                .filter(Requests.transaction_id == cur_request_id, Requests.shift_id == cur_shift_id).first()
+            return render_template("approve_request.html", request=request_to_approve,
+                                   shift=Shifts.query.get(cur_shift_id), hospital=cur_hospital, logged_in=True), 409
+
+        bump_board_version(current_user.id)
+        publish_shift_event(current_user.id, 'shift-approved', int(cur_shift_id))
         db.session.commit()
-        return redirect(url_for('app_request_email', shift=shift_to_update.shift_id,
-                                app_request=request_to_approve.transaction_id))
+        return redirect(url_for('app_request_email', shift=cur_shift_id, app_request=cur_request_id))
 
     request_id = request.args.get('id')
     cur_request = Requests.query.get(request_id)
@@ -443,12 +3260,13 @@ def approve_request():
 
 
 @app.route('/request_details', methods=['GET', 'POST'])
+@read_replica
 @login_required
 def request_detail():
     """
     allows admins to dig deeper in the requests for the pending shifts
     """
-    cur_hospital = Hospital.query.get(current_user.id)
+    cur_hospital = get_hospital(current_user.id)
     shift_id = request.args.get('id')
     request_details = db.session.query(Requests) \
         .join(Shifts, Shifts.shift_id == Requests.shift_id) \
@@ -463,17 +3281,114 @@ def request_detail():
 
 
 @app.route('/shift_history', methods=['GET'])
+@read_replica
 def shift_history():
     """
     allows anybody to see all approved shifts
     """
     hospital_id = request.args['hospital_id']
-    cur_hospital = Hospital.query.get(hospital_id)
-    shift_history_list = db.session.query(Shifts) \
-        .filter(Shifts.status == 'Approved', Shifts.hospital_id == hospital_id) \
-        .order_by(Shifts.picked_up_by, Shifts.date, Shifts.start_time, Shifts.area, Shifts.role)
+    cur_hospital = get_hospital(hospital_id)
+
+    return board_response(hospital_id,
+                          lambda: render_template('shift_history.html', hospital=cur_hospital, logged_in=True))
+
+
+@app.route('/shift_history/data', methods=['GET'])
+@read_replica
+def shift_history_data():
+    """
+    one page of the shift history table (DataTables server-side processing)
+    """
+    hospital_id = request.args['hospital_id']
+    columns = [Shifts.picked_up_by, Shifts.role, Shifts.area, Shifts.date, Shifts.start_dt_tm, Shifts.end_dt_tm,
+               Shifts.contact_name]
+    search_columns = [Shifts.picked_up_by, Shifts.role, Shifts.area, Shifts.contact_name]
+    default_order = [Shifts.picked_up_by, Shifts.date, Shifts.start_dt_tm, Shifts.start_time, Shifts.area, Shifts.role,
+                     Shifts.shift_id]
+
+    def row_to_dict(row):
+        return {
+            'picked_up_by': row.picked_up_by,
+            'role': row.role,
+            'area': row.area,
+            'date': str(row.date),
+            'start_time': row.start_time,
+            'end_time': row.end_time,
+            'contact_name': row.contact_name,
+            'contact_email': row.contact_email
+        }
+
+    return board_response(
+        hospital_id,
+        lambda: datatables_page(approved_shifts_query(hospital_id), columns, search_columns, default_order,
+                                row_to_dict),
+        datatables_response
+    )
+
+
+@app.route('/export/shift_history', methods=['GET'])
+@login_required
+def export_shift_history():
+    """
+    allows admins to download the approved shifts (optionally for a date range) as CSV or XLSX
+    """
+    start, end = export_date_range()
+    shift_history_list = approved_shifts_query(current_user.id)
+    if start:
+        shift_history_list = shift_history_list.filter(Shifts.date >= start)
+    if end:
+        shift_history_list = shift_history_list.filter(Shifts.date <= end)
+    shift_history_list = shift_history_list.order_by(Shifts.date, Shifts.start_dt_tm, Shifts.shift_id)
+    return export_response(shift_history_list, SHIFT_HISTORY_EXPORT_COLUMNS, 'shift_history')
 
-    return render_template('shift_history.html', hospital=cur_hospital, shifts=shift_history_list, logged_in=True)
+
+@app.route('/export/requests', methods=['GET'])
+@login_required
+def export_requests():
+    """
+    allows admins to download every request made (optionally in a date range) as CSV or XLSX
+    """
+    start, end = export_date_range()
+
+    def request_log(shifts, requests):
+        models = {Shifts: shifts, Requests: requests}
+        log = db.session.query(*[getattr(models[column.class_], column.key)
+                                 for header, column in REQUEST_EXPORT_COLUMNS]) \
+            .join(shifts, shifts.shift_id == requests.shift_id) \
+            .filter(requests.hospital_id == current_user.id)
+        if start:
+            log = log.filter(requests.create_dt_tm >= start)
+        if end:
+            log = log.filter(requests.create_dt_tm < end + timedelta(days=1))
+        return log
+
+    request_log = with_archive(request_log).order_by(Requests.create_dt_tm, Requests.transaction_id)
+    return export_response(request_log, REQUEST_EXPORT_COLUMNS, 'requests')
+
+
+@app.route('/analytics', methods=['GET'])
+@read_replica
+@login_required
+def analytics():
+    """
+    allows admins to see fill rate, time to fill and request volume by week, area and role (optionally for a date
+    range, the last ANALYTICS_WEEKS weeks by default). only reads the rollups
+    """
+    cur_hospital = get_hospital(current_user.id)
+    start, end = export_date_range()
+    end = end or date.today()
+    start = start or end - timedelta(days=end.weekday(), weeks=app.config['ANALYTICS_WEEKS'] - 1)
+    rollups = ShiftRollup.query \
+        .filter(ShiftRollup.hospital_id == current_user.id, ShiftRollup.shift_date >= start,
+                ShiftRollup.shift_date <= end) \
+        .all()
+    return render_template('analytics.html', hospital=cur_hospital, logged_in=True, start=start, end=end,
+                           totals=rollup_summary(rollups, lambda row: 'All shifts'),
+                           weeks=rollup_summary(rollups, lambda row: row.shift_date
+                                                - timedelta(days=row.shift_date.weekday())),
+                           areas=rollup_summary(rollups, lambda row: row.area or '(none)'),
+                           roles=rollup_summary(rollups, lambda row: row.role or '(none)'),
+                           refreshed=get_watermark('shift_rollup'))
 
 
 @app.route('/remove_shift', methods=['GET', 'POST'])
@@ -482,11 +3397,14 @@ def remove_shift():
     """
     allows admins to remove pending shifts
     """
-    cur_hospital = Hospital.query.get(current_user.id)
+    cur_hospital = get_hospital(current_user.id)
     if request.method == "POST":
         cur_shift_id = request.form["id"]
         shift_to_remove = Shifts.query.get(cur_shift_id)
         shift_to_remove.status = "Removed"
+        shift_to_remove.closed_dt_tm = datetime.now()
+        bump_board_version(shift_to_remove.hospital_id)
+        publish_shift_event(shift_to_remove.hospital_id, 'shift-removed', shift_to_remove.shift_id)
         db.session.commit()
         return redirect(url_for('pending_shifts'))
     shift_id = request.args.get('id')
@@ -500,7 +3418,7 @@ def edit_shift():
     """
     allows admins to edit pending shifts
     """
-    cur_hospital = Hospital.query.get(current_user.id)
+    cur_hospital = get_hospital(current_user.id)
     if request.method == "POST":
         shift_id = request.form["id"]
         shift_to_update = Shifts.query.get(shift_id)
@@ -509,9 +3427,15 @@ def edit_shift():
         shift_to_update.date = datetime.strptime(request.form["date"], '%Y-%m-%d')
         shift_to_update.start_time = request.form["start_time"]
         shift_to_update.end_time = request.form["end_time"]
+        for column, value in shift_times(shift_to_update.date, shift_to_update.start_time,
+                                         shift_to_update.end_time).items():
+            setattr(shift_to_update, column, value)
         shift_to_update.comments = request.form["comments"]
         shift_to_update.contact_name = request.form["contact_name"]
         shift_to_update.contact_email = request.form["contact_email"]
+        bump_board_version(shift_to_update.hospital_id)
+        publish_shift_event(shift_to_update.hospital_id, 'shift-updated', shift_to_update.shift_id,
+                            shift_event_payload(shift_to_update))
         db.session.commit()
         return redirect(url_for('pending_shifts'))
     shift_id = request.args.get('id')
@@ -525,52 +3449,10 @@ def app_request_email():
     """
     triggers emails to be sent if request is approved
     """
-    shift_id = request.args['shift']
-    shift = Shifts.query.get(shift_id)
-    shift_email = shift.contact_email
-    shift_name = shift.contact_name
-
-    app_request_id = request.args['app_request']
-    app_request = Requests.query.get(app_request_id)
-    request_email = app_request.requested_by_email
-    request_name = app_request.requested_by_name
-
-    contents = f"{request_name} - great news, your request for the {shift.date} shift in the {shift.area} area " \
-               f"was approved!\n" \
-               f"Please reach out to {shift_name} ({shift_email}) with any questions you might have.\n" \
-               "From,\nYour trusty pals at Shift Helper"
-
-    with smtplib.SMTP("smtp.office365.com", 587) as connection:
-        connection.starttls()
-        connection.login(email_address, email_password)
-        connection.sendmail(
-            from_addr=email_address,
-            to_addrs=[request_email, shift_email],
-            msg=f"Subject:Your request for the {shift.date} shift has been approved!\n\n{contents}"
-        )
-
-    pass_emails = []
-    requests_to_pass = db.session.query(Requests) \
-        .filter(Requests.shift_id == shift_id, Requests.status == 'Passed')
-
-    for req in requests_to_pass:
-        pass_emails.append(req.requested_by_email)
-
-    contents = f"Thank you for submitting a request for the {shift.date} shift in the {shift.area} area.\n" \
-               "Unfortunately this shift was given to someone else. Thanks again for your interest in this shift and " \
-               "please do continue to requesting more shifts. We need all the help we can get\n" \
-               "From, Your trusty pals at Shift Helper"
-
-    pass_emails.append(email_address)
-    to_adds = ", ".join(pass_emails)
-    with smtplib.SMTP("smtp.office365.com", 587) as connection:
-        connection.starttls()
-        connection.login(email_address, email_password)
-        connection.sendmail(
-            from_addr=email_address,
-            to_addrs=to_adds,
-            msg=f"Subject:Sorry, request for the {shift.date} shift was approved for someone else\n\n{contents}"
-        )
+    shift = Shifts.query.get(request.args['shift'])
+    app_request = Requests.query.get(request.args['app_request'])
+    queue_approval_emails(shift, app_request)
+    db.session.commit()
 
     return redirect(url_for('pending_shifts'))
 
@@ -585,7 +3467,7 @@ def staff_request_email():
     shift_email = shift.contact_email
     shift_name = shift.contact_name
 
-    cur_hospital = Hospital.query.get(shift.hospital_id)
+    cur_hospital = get_hospital(shift.hospital_id)
     staff_request_name = request.args['staff_request_name']
     staff_request_email_addr = request.args['staff_request_email']
 
@@ -594,18 +3476,223 @@ def staff_request_email():
                "Please navigate to the app to review the request.\n\n" \
                "From,\nYour trusty pals at Shift Helper"
 
-    with smtplib.SMTP("smtp.office365.com", 587) as connection:
-        connection.starttls()
-        connection.login(email_address, email_password)
-        connection.sendmail(
-            from_addr=email_address,
-            to_addrs=[shift_email],
-            msg=f"Subject:Your posted shift on {shift.date} in the {shift.area} area  has been requested!\n\n{contents}"
-        )
+    queue_email(shift_email, f"Your posted shift on {shift.date} in the {shift.area} area  has been requested!",
+                contents)
+    db.session.commit()
     return render_template('request_success.html', contact=shift.contact_name, hospital=cur_hospital
                            , logged_in=True)
 
 
+@app.route('/api/v1/shifts', methods=['GET'])
+@api_token_required
+def api_shifts():
+    """
+    lists the hospital's shifts a page at a time (see api_page). status (comma separated), date_from and date_to
+    (YYYY-MM-DD), area and role narrow the list. archived shifts aren't included
+    """
+    shifts_query = Shifts.query.filter(Shifts.hospital_id == g.api_hospital_id)
+    if request.args.get('status'):
+        shifts_query = shifts_query.filter(Shifts.status.in_(request.args['status'].split(',')))
+    date_from, date_to = api_date_arg('date_from'), api_date_arg('date_to')
+    if date_from:
+        shifts_query = shifts_query.filter(Shifts.date >= date_from)
+    if date_to:
+        shifts_query = shifts_query.filter(Shifts.date <= date_to)
+    if request.args.get('area'):
+        shifts_query = shifts_query.filter(Shifts.area == request.args['area'])
+    if request.args.get('role'):
+        shifts_query = shifts_query.filter(Shifts.role == request.args['role'])
+
+    rows, next_cursor, has_more = api_page(shifts_query, Shifts.shift_id)
+    return jsonify(shifts=[api_shift_to_dict(row) for row in rows], next_cursor=next_cursor, has_more=has_more)
+
+
+@app.route('/api/v1/shifts/batch', methods=['POST'])
+@api_token_required
+def api_shifts_batch():
+    """
+    creates, updates and removes many of the hospital's shifts in one transaction. the body is
+
+        {"create": [{"area": ..., "role": ..., "date": "YYYY-MM-DD", ...}, ...],
+         "update": [{"shift_id": ..., <fields to change>}, ...],
+         "remove": [{"shift_id": ...}, ...],
+         "atomic": false}
+
+    with the same fields as ShiftForm. any item can carry a "ref", which is echoed back in its result. only open shifts
+    can be updated or removed.
+
+    each item gets a result, in the order sent. items with problems are rejected and the rest applied, unless atomic
+    is true, in which case nothing is applied if any item has a problem (and the response is a 422)
+    """
+    hospital_id = g.api_hospital_id
+    batch = request.get_json(silent=True)
+    if not isinstance(batch, dict):
+        api_error(400, 'the body must be a JSON object')
+    operations = OrderedDict((operation, batch.get(operation, [])) for operation in ('create', 'update', 'remove'))
+    for operation, items in operations.items():
+        if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+            api_error(400, f'{operation} must be a list of objects')
+    if sum(len(items) for items in operations.values()) > app.config['API_BATCH_SIZE']:
+        api_error(413, f"at most {app.config['API_BATCH_SIZE']} items can be sent in one batch")
+
+    # the shifts being changed are locked (where the database supports it) so an approval can't slip in between the
+    # status check here and the change
+    shift_ids = [api_id(item.get('shift_id')) for item in operations['update'] + operations['remove']]
+    existing_shifts = {}
+    if any(shift_ids):
+        existing_shifts = {shift.shift_id: shift for shift in Shifts.query.filter(
+            Shifts.shift_id.in_([shift_id for shift_id in shift_ids if shift_id]),
+            Shifts.hospital_id == hospital_id).with_for_update()}
+
+    checked_items = []
+    for operation, items in operations.items():
+        for item in items:
+            shift = None
+            values, errors = api_shift_values(item, required=True) if operation == 'create' else ({}, [])
+            if operation != 'create':
+                shift_id = api_id(item.get('shift_id'))
+                shift = existing_shifts.get(shift_id)
+                if shift is None:
+                    errors.append("shift_id isn't one of this hospital's shifts")
+                elif shift_ids.count(shift_id) > 1:
+                    errors.append("the shift is in the batch more than once")
+                elif shift.status not in OPEN_SHIFT_STATUSES:
+                    errors.append(f"the shift is {shift.status.lower()} so it can't be changed")
+            if operation == 'update':
+                values, value_errors = api_shift_values(item, required=False)
+                errors += value_errors
+            checked_items.append((operation, item, shift, values, errors))
+
+    rejected = sum(1 for *_, errors in checked_items if errors)
+    apply_changes = not (rejected and batch.get('atomic') is True)
+    cur_dt = datetime.now().replace(microsecond=0)
+    results = OrderedDict((operation, []) for operation in operations)
+    applied = []
+    for operation, item, shift, values, errors in checked_items:
+        result = {'ref': item['ref']} if 'ref' in item else {}
+        if errors:
+            result.update(status='rejected', errors=errors)
+        elif not apply_changes:
+            result.update(status='skipped')
+        elif operation == 'create':
+            shift = Shifts(hospital_id=hospital_id, status='Posted', create_dt_tm=cur_dt, **values,
+                           **shift_times(values['date'], values['start_time'], values['end_time']))
+            db.session.add(shift)
+            result.update(status='created')
+        elif operation == 'update':
+            for column, value in values.items():
+                setattr(shift, column, value)
+            if values.keys() & {'date', 'start_time', 'end_time'}:
+                for column, value in shift_times(shift.date, shift.start_time, shift.end_time).items():
+                    setattr(shift, column, value)
+            result.update(status='updated')
+        else:
+            shift.status = 'Removed'
+            shift.closed_dt_tm = datetime.now()
+            result.update(status='removed')
+        if result['status'] not in ('rejected', 'skipped'):
+            applied.append((result, shift))
+        results[operation].append(result)
+
+    if applied:
+        db.session.flush()
+        for result, shift in applied:
+            result['shift'] = api_shift_to_dict(shift)
+        bump_board_version(hospital_id)
+        publish_shift_event(hospital_id, 'board-changed')
+        db.session.commit()
+    else:
+        db.session.rollback()
+
+    return jsonify(applied=len(applied), rejected=rejected, **results), 200 if apply_changes else 422
+
+
+@app.route('/api/v1/requests', methods=['GET'])
+@api_token_required
+def api_requests():
+    """
+    lists the hospital's requests a page at a time (see api_page), so keeping the last cursor picks up new requests on
+    the next sync. shift_id and status (comma separated) narrow the list. requests for archived shifts aren't
+    included
+    """
+    requests_query = Requests.query.filter(Requests.hospital_id == g.api_hospital_id)
+    if request.args.get('shift_id'):
+        requests_query = requests_query.filter(Requests.shift_id == request.args.get('shift_id', type=int))
+    if request.args.get('status'):
+        requests_query = requests_query.filter(Requests.status.in_(request.args['status'].split(',')))
+
+    rows, next_cursor, has_more = api_page(requests_query, Requests.transaction_id)
+    return jsonify(requests=[api_request_to_dict(row) for row in rows], next_cursor=next_cursor, has_more=has_more)
+
+
+@app.route('/api/v1/requests/approve', methods=['POST'])
+@api_token_required
+def api_approve_requests():
+    """
+    approves many requests in one transaction. the body is {"request_ids": [...]} and each id gets a result, in the
+    order sent.
+
+    as in approve_request, approving a request passes over the shift's other requests, and a request whose shift has
+    already been filled or removed (including by an earlier id in the same batch) is rejected. the approval emails
+    are queued as they are for the web app
+    """
+    hospital_id = g.api_hospital_id
+    batch = request.get_json(silent=True)
+    request_ids = batch.get('request_ids') if isinstance(batch, dict) else None
+    if not isinstance(request_ids, list):
+        api_error(400, 'the body must be a JSON object with a request_ids list')
+    if len(request_ids) > app.config['API_BATCH_SIZE']:
+        api_error(413, f"at most {app.config['API_BATCH_SIZE']} items can be sent in one batch")
+
+    requests_to_approve = {}
+    valid_ids = [request_id for request_id in map(api_id, request_ids) if request_id]
+    if valid_ids:
+        requests_to_approve = {app_request.transaction_id: app_request for app_request in Requests.query.filter(
+            Requests.transaction_id.in_(valid_ids), Requests.hospital_id == hospital_id)}
+
+    cur_dt = datetime.now().replace(second=0, microsecond=0)
+    results = []
+    approved = []
+    for request_id in request_ids:
+        app_request = requests_to_approve.get(api_id(request_id))
+        if app_request is None:
+            results.append({'request_id': request_id, 'status': 'rejected',
+                            'errors': ["request_id isn't one of this hospital's requests"]})
+        elif not approve_shift_request(hospital_id, app_request.shift_id, app_request.transaction_id, cur_dt):
+            results.append({'request_id': request_id, 'shift_id': app_request.shift_id, 'status': 'rejected',
+                            'errors': ["the shift has already been filled or removed"]})
+        else:
+            publish_shift_event(hospital_id, 'shift-approved', app_request.shift_id)
+            results.append({'request_id': request_id, 'shift_id': app_request.shift_id, 'status': 'approved'})
+            approved.append(app_request)
+
+    if approved:
+        bump_board_version(hospital_id)
+        for app_request in approved:
+            queue_approval_emails(Shifts.query.get(app_request.shift_id), app_request)
+        db.session.commit()
+    else:
+        db.session.rollback()
+
+    return jsonify(approved=len(approved), rejected=len(results) - len(approved), requests=results)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """
+    per-route latency, status and SQL metrics (and cache stats) for Prometheus to scrape
+    """
+    if not app.config['METRICS_TOKEN']:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {app.config['METRICS_TOKEN']}"):
+        abort(401)
+    gauges = {}
+    for cache_name, cache in (('hospital', hospital_cache), ('board', board_cache)):
+        for stat, value in cache.stats().items():
+            gauges[(f'cache_{stat}', (('cache', cache_name),))] = value
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+
 # logout
 @app.route('/logout')
 def logout():
@@ -617,5 +3704,10 @@ def logout():
     return render_template('index.html')
 
 
+if app.config['WORKER_THREAD']:
+    threading.Thread(target=run_worker, name='worker', daemon=True).start()
+
+
 if __name__ == '__main__':
+    upgrade_db()
     app.run(debug=debug)
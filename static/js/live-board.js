@@ -0,0 +1,52 @@
+// listens to a hospital's live shift feed (Server-Sent Events) and calls handlers[eventType](data) for each event.
+// the browser reconnects by itself and picks up where it left off
+function listenForShiftEvents(url, handlers) {
+    if (!window.EventSource) {
+        return null;
+    }
+    var source = new EventSource(url);
+    Object.keys(handlers).forEach(function (eventType) {
+        source.addEventListener(eventType, function (event) {
+            handlers[eventType](JSON.parse(event.data));
+        });
+    });
+    return source;
+}
+
+// for the tables paged on the server: the row showing the shift, if it's on the current page
+function findShiftRow(table, shiftId) {
+    var row = table.row(function (index, data) { return data.shift_id === shiftId; });
+    return row.any() ? row : null;
+}
+
+// redraws the shift's row with the event's fields, without going back to the server
+function patchShiftRow(table, shift) {
+    var row = findShiftRow(table, shift.shift_id);
+    if (row) {
+        row.data($.extend({}, row.data(), shift));
+    }
+}
+
+// takes the shift's row off the current page, without going back to the server
+function dropShiftRow(table, event) {
+    var row = findShiftRow(table, event.shift_id);
+    if (row) {
+        $(row.node()).fadeOut();
+    }
+}
+
+// changes that could move rows between pages aren't fetched by every open page at once. a notice above the table
+// lets the person looking at it refresh when they want to
+function showRefreshNotice(table, message) {
+    var container = $(table.table().container());
+    if (container.prev('.refresh-notice').length) {
+        return;
+    }
+    var notice = $('<div class="alert alert-info refresh-notice"></div>').text(message + ' ');
+    $('<a href="#">Refresh</a>').appendTo(notice).on('click', function (event) {
+        event.preventDefault();
+        notice.remove();
+        table.ajax.reload(null, false);
+    });
+    notice.insertBefore(container);
+}
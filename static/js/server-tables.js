@@ -0,0 +1,8 @@
+// helpers for the tables that page, sort and search on the server (DataTables server-side processing)
+function escapeHtml(value) {
+    return $('<div>').text(value == null ? '' : value).html();
+}
+
+function mailtoLink(email, name) {
+    return '<a href="mailto:' + escapeHtml(email) + '">' + escapeHtml(name) + '</a>';
+}